@@ -1,23 +1,27 @@
+import asyncio
 import uvicorn
+import time
+import uuid
 
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-from fastapi import Depends, FastAPI, Header, Query, Response, UploadFile
+from fastapi import Depends, FastAPI, Header, Query, Response, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.params import File
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
-from fooocusapi.models import AllModelNamesResponse, AsyncJobResponse, QueryJobRequest,StopResponse , GeneratedImageResult, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, JobQueueInfo, Text2ImgRequest
-from fooocusapi.api_utils import generation_output, req_to_params
+from fooocusapi.models import AllModelNamesResponse, AsyncJobResponse, CancelJobRequest, QueryJobRequest, QueryJobsRequest, QueryJobsResponse, StreamJobRequest, StopResponse , GeneratedImageResult, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, JobQueueInfo, Text2ImgRequest
+from fooocusapi.api_utils import generation_output, job_status_output, params_to_coalesce_key, req_to_params, run_codec
+from fooocusapi.job_stream import job_event_stream, multipart_result_stream, ndjson_result_stream, sse_job_stream, wait_for_job_change
+from fooocusapi.progress_events import get_current_version
 import fooocusapi.file_utils as file_utils
 from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
-from fooocusapi.task_queue import TaskType
-from fooocusapi.worker import process_generate, task_queue, process_top
+from fooocusapi.task_queue import QueueTask, TaskType, task_priority_rank
+from fooocusapi.worker import task_queue, process_top
 from fooocusapi.models_v2 import *
 from fooocusapi.img_utils import base64_to_stream
 
-from concurrent.futures import ThreadPoolExecutor
-
 
 app = FastAPI()
 
@@ -29,12 +33,9 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有请求头
 )
 
-work_executor = ThreadPoolExecutor(
-    max_workers=task_queue.queue_size*2, thread_name_prefix="worker_")
-
 img_generate_responses = {
     "200": {
-        "description": "PNG bytes if request's 'Accept' header is 'image/png', otherwise JSON",
+        "description": "PNG bytes if request's 'Accept' header is 'image/png', streamed multipart/mixed PNG parts if more than one image is requested, a JSON line for each image if 'application/x-ndjson', otherwise JSON",
         "content": {
             "application/json": {
                 "example": [{
@@ -51,13 +52,22 @@ img_generate_responses = {
             },
             "image/png": {
                 "example": "PNG bytes, what did you expect?"
+            },
+            "multipart/mixed": {
+                "example": "A part of PNG bytes for each image, sent as soon as the image is finished"
+            },
+            "application/x-ndjson": {
+                "example": '{"base64": null, "url": "...", "seed": "1050625087", "finish_reason": "SUCCESS"}'
             }
         }
     }
 }
 
 
-def call_worker(req: Text2ImgRequest, accept: str):
+def request_to_job(req: Text2ImgRequest, accept: str) -> dict:
+    """
+    Arguments of `TaskQueue.add_task` for the request
+    """
     task_type = TaskType.text_2_img
     if isinstance(req, ImgUpscaleOrVaryRequest) or isinstance(req, ImgUpscaleOrVaryRequestJson):
         task_type = TaskType.img_uov
@@ -67,21 +77,95 @@ def call_worker(req: Text2ImgRequest, accept: str):
         task_type = TaskType.img_prompt
 
     params = req_to_params(req)
-    queue_task = task_queue.add_task(
-        task_type, {'params': params.__dict__, 'accept': accept, 'require_base64': req.require_base64})
+    return dict(type=task_type, req_param={'params': params.__dict__, 'accept': accept, 'require_base64': req.require_base64},
+                params=params, priority=req.priority, coalesce_key=params_to_coalesce_key(params),
+                deadline_millis=None if req.deadline_ms is None else int(round(time.time() * 1000)) + req.deadline_ms)
+
+
+def submit_task(req: Text2ImgRequest, accept: str, client_id: str | None = None) -> QueueTask | None:
+    return task_queue.add_task(client_id=client_id, **request_to_job(req, accept))
+
+
+def submit_batch(req: BatchGenerationRequest, client_id: str | None = None) -> Tuple[List[QueueTask] | None, bool]:
+    """
+    :returns: The queued tasks, or None if the batch is rejected, and whether it's rejected for exceeding the capacity
+        of the queue, so retrying never succeeds
+    """
+    jobs = []
+    for job in req.jobs:
+        decode_request_images(job)
+        jobs.append(request_to_job(job, 'application/json'))
+    queue_tasks = task_queue.add_tasks(jobs, client_id)
+    return queue_tasks, queue_tasks is None and task_queue.exceeds_capacity(jobs)
+
+
+def decode_request_images(req: Text2ImgRequest):
+    """
+    Decode the base64 images of v2 requests in place
+    """
+    if isinstance(req, ImgUpscaleOrVaryRequestJson):
+        req.input_image = base64_to_stream(req.input_image)
+    elif isinstance(req, ImgInpaintOrOutpaintRequestJson):
+        req.input_image = base64_to_stream(req.input_image)
+        if req.input_mask is not None:
+            req.input_mask = base64_to_stream(req.input_mask)
+    elif isinstance(req, ImgPromptRequestJson):
+        default_image_promt = ImagePrompt(cn_img=None)
+        image_prompts_files: List[ImagePrompt] = []
+        for img_prompt in req.image_prompts:
+            img_prompt.cn_img = base64_to_stream(img_prompt.cn_img)
+            image = ImagePrompt(cn_img=img_prompt.cn_img,
+                                cn_stop=img_prompt.cn_stop,
+                                cn_weight=img_prompt.cn_weight,
+                                cn_type=img_prompt.cn_type)
+            image_prompts_files.append(image)
+
+        while len(image_prompts_files) <= 4:
+            image_prompts_files.append(default_image_promt)
+
+        req.image_prompts = image_prompts_files
+
+
+async def call_worker(req: Text2ImgRequest, accept: str, client_id: str | None = None, stream_results: bool = False):
+    # Decodes the input images
+    queue_task = await run_codec(submit_task, req, accept, client_id)
 
     if queue_task is None:
         print("[Task Queue] The task queue has reached limit")
         results = [ImageGenerationResult(im=None, seed=0,
-                                         finish_reason=GenerationFinishReason.queue_is_full)]
+                                         finish_reason=GenerationFinishReason.queue_is_full,
+                                         retry_after=task_queue.get_retry_after(req.priority))]
     elif req.async_process:
-        work_executor.submit(process_generate, queue_task, params)
+        task_queue.update_estimated_times()
+        results = queue_task
+    elif stream_results:
+        # The response sends the results as they are finished
         results = queue_task
     else:
-        results = process_generate(queue_task, params)
+        # Shielded, a client going away must not cancel the future shared with the worker and identical requests
+        results = await asyncio.shield(asyncio.wrap_future(queue_task.future))
 
     return results
 
+async def generation_response(req: Text2ImgRequest, accept: str, client_id: str | None = None):
+    """
+    Run the request, for multipart/mixed, application/x-ndjson, or image/png with more than one image,
+    the images are streamed as soon as each one is finished
+    """
+    stream_results = not req.async_process and (accept in ('multipart/mixed', 'application/x-ndjson') or
+                                                (accept == 'image/png' and req.image_number > 1))
+    results = await call_worker(req, accept, client_id, stream_results)
+    if stream_results and isinstance(results, QueueTask):
+        if accept == 'application/x-ndjson':
+            return StreamingResponse(ndjson_result_stream(results, req.require_base64), media_type='application/x-ndjson')
+        boundary = uuid.uuid4().hex
+        return StreamingResponse(multipart_result_stream(results, boundary),
+                                 media_type=f'multipart/mixed; boundary={boundary}')
+
+    streaming_output = accept == 'image/png' or stream_results
+    return await run_codec(generation_output, results, streaming_output, req.require_base64)
+
+
 def stop_worker():
     process_top()
 
@@ -91,162 +175,185 @@ def home():
 
 
 @app.post("/v1/generation/text-to-image", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def text2img_generation(req: Text2ImgRequest, accept: str = Header(None),
+async def text2img_generation(req: Text2ImgRequest, accept: str = Header(None),
+                        client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                         accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    return await generation_response(req, accept, client_id)
 
 
 @app.post("/v1/generation/image-upscale-vary", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_upscale_or_vary(input_image: UploadFile, req: ImgUpscaleOrVaryRequest = Depends(ImgUpscaleOrVaryRequest.as_form),
+async def img_upscale_or_vary(input_image: UploadFile, req: ImgUpscaleOrVaryRequest = Depends(ImgUpscaleOrVaryRequest.as_form),
                         accept: str = Header(None),
+                        client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                         accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    return await generation_response(req, accept, client_id)
 
 
 @app.post("/v2/generation/image-upscale-vary", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_upscale_or_vary_v2(req: ImgUpscaleOrVaryRequestJson,
+async def img_upscale_or_vary_v2(req: ImgUpscaleOrVaryRequestJson,
                            accept: str = Header(None),
+                           client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                            accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-    req.input_image = base64_to_stream(req.input_image)
+    await run_codec(decode_request_images, req)
 
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    return await generation_response(req, accept, client_id)
 
 
 @app.post("/v1/generation/image-inpait-outpaint", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_inpaint_or_outpaint(input_image: UploadFile, req: ImgInpaintOrOutpaintRequest = Depends(ImgInpaintOrOutpaintRequest.as_form),
+async def img_inpaint_or_outpaint(input_image: UploadFile, req: ImgInpaintOrOutpaintRequest = Depends(ImgInpaintOrOutpaintRequest.as_form),
                             accept: str = Header(None),
+                            client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                             accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    return await generation_response(req, accept, client_id)
 
 
 @app.post("/v2/generation/image-inpait-outpaint", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_inpaint_or_outpaint_v2(req: ImgInpaintOrOutpaintRequestJson,
+async def img_inpaint_or_outpaint_v2(req: ImgInpaintOrOutpaintRequestJson,
                             accept: str = Header(None),
+                            client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                             accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-
-    req.input_image = base64_to_stream(req.input_image)
-    if req.input_mask is not None:
-        req.input_mask = base64_to_stream(req.input_mask)
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    await run_codec(decode_request_images, req)
+    return await generation_response(req, accept, client_id)
 
 
 @app.post("/v1/generation/image-prompt", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_prompt(cn_img1: Optional[UploadFile] = File(None),
+async def img_prompt(cn_img1: Optional[UploadFile] = File(None),
                req: ImgPromptRequest = Depends(ImgPromptRequest.as_form),
                accept: str = Header(None),
+               client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    return await generation_response(req, accept, client_id)
 
 
 @app.post("/v2/generation/image-prompt", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_prompt(req: ImgPromptRequestJson,
+async def img_prompt(req: ImgPromptRequestJson,
                accept: str = Header(None),
+               client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling"),
                accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
-    if accept == 'image/png':
-        streaming_output = True
-        # image_number auto set to 1 in streaming mode
-        req.image_number = 1
-    else:
-        streaming_output = False
-    
-    default_image_promt = ImagePrompt(cn_img=None)
-    image_prompts_files: List[ImagePrompt] = []
-    for img_prompt in req.image_prompts:
-        img_prompt.cn_img = base64_to_stream(img_prompt.cn_img)
-        image = ImagePrompt(cn_img=img_prompt.cn_img,
-                            cn_stop=img_prompt.cn_stop,
-                            cn_weight=img_prompt.cn_weight,
-                            cn_type=img_prompt.cn_type)
-        image_prompts_files.append(image)
-    
-    while len(image_prompts_files) <= 4:
-        image_prompts_files.append(default_image_promt)
-    
-    req.image_prompts = image_prompts_files
-
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    await run_codec(decode_request_images, req)
+
+    return await generation_response(req, accept, client_id)
+
+
+@app.post("/v2/generation/batch", response_model=BatchGenerationResponse, description="Submit async generation jobs with one admission decision, either all jobs are queued or none")
+async def batch_generation(req: BatchGenerationRequest,
+                           client_id: str | None = Header(None, alias="X-Client-Id", description="Client identity for fair share scheduling")):
+    queue_tasks, exceeds_capacity = await run_codec(submit_batch, req, client_id)
+    if exceeds_capacity:
+        print("[Task Queue] The batch exceeds the capacity of task queue")
+        return Response(status_code=413, content=GenerationFinishReason.queue_is_full.value)
+    if queue_tasks is None:
+        print("[Task Queue] The task queue has reached limit")
+        priority = max([job.priority for job in req.jobs], key=lambda p: task_priority_rank[p])
+        return Response(status_code=409, content=GenerationFinishReason.queue_is_full.value,
+                        headers={'Retry-After': str(task_queue.get_retry_after(priority))})
+
+    return BatchGenerationResponse(job_ids=[task.job_id for task in queue_tasks])
 
 
 @app.get("/v1/generation/query-job", response_model=AsyncJobResponse, description="Query async generation job")
-def query_job(req: QueryJobRequest=Depends()):
+async def query_job(req: QueryJobRequest=Depends()):
+    queue_task = task_queue.get_task(req.job_id, True)
+    if queue_task is None:
+        return Response(content="Job not found", status_code=404)
+    if req.wait_for_change and not queue_task.is_finished:
+        # Long poll, parked on the event loop without holding a thread
+        await wait_for_job_change(queue_task, req.timeout)
+    if not queue_task.is_finished:
+        task_queue.update_estimated_times()
+
+    return await run_codec(generation_output, queue_task, streaming_output=False, require_base64=False,
+                           require_step_preivew=req.require_step_preivew)
+
+
+@app.post("/v1/generation/query-jobs", response_model=QueryJobsResponse, description="Query status of many async generation jobs, optionally only the jobs changed since the previous query")
+async def query_jobs(req: QueryJobsRequest):
+    # Read before the jobs, so changes during this query are returned again next time
+    version = get_current_version()
+    queue_tasks = []
+    not_found = []
+    for job_id in req.job_ids:
+        queue_task = task_queue.get_task(job_id, True)
+        if queue_task is None:
+            not_found.append(job_id)
+        elif req.since_version is None or queue_task.events.version > req.since_version:
+            queue_tasks.append(queue_task)
+
+    if req.require_result:
+        jobs = await run_codec(lambda: [job_status_output(task, True) for task in queue_tasks])
+    else:
+        jobs = [job_status_output(task, False) for task in queue_tasks]
+    return QueryJobsResponse(version=version, jobs=jobs, not_found=not_found)
+
+
+@app.get("/v1/generation/stream", description="Stream progress and result of a job as Server-Sent Events, a WebSocket connection to the same path receives the same events as JSON messages")
+async def stream_job(req: StreamJobRequest=Depends()):
     queue_task = task_queue.get_task(req.job_id, True)
     if queue_task is None:
         return Response(content="Job not found", status_code=404)
 
-    return generation_output(queue_task, streaming_output=False, require_base64=False, require_step_preivew=req.require_step_preivew)
+    return StreamingResponse(sse_job_stream(queue_task, req.preview_interval_ms), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/v1/generation/stream")
+async def stream_job_websocket(websocket: WebSocket, job_id: str = Query(description="Job ID to stream"),
+                               preview_interval_ms: int | None = Query(None, ge=0)):
+    queue_task = task_queue.get_task(job_id, True)
+    if queue_task is None:
+        await websocket.close(code=1008, reason="Job not found")
+        return
+
+    await websocket.accept()
+    try:
+        async for event, data in job_event_stream(queue_task, preview_interval_ms):
+            await websocket.send_json({"event": event, "data": data})
+        await websocket.close()
+    except (WebSocketDisconnect, OSError):
+        # Client is gone
+        pass
 
 
 @app.get("/v1/generation/job-queue", response_model=JobQueueInfo, description="Query job queue info")
 def job_queue():
-    return JobQueueInfo(running_size=len(task_queue.queue), finished_size=len(task_queue.history), last_job_id=task_queue.last_job_id)
+    estimated_times = task_queue.update_estimated_times()
+    estimated_finish_millis = max([finish_millis for _, finish_millis in estimated_times.values()], default=None)
+    return JobQueueInfo(running_size=task_queue.get_job_count(), finished_size=len(task_queue.history), last_job_id=task_queue.last_job_id,
+                        model_swaps=task_queue.model_swaps, model_swaps_avoided=task_queue.model_swaps_avoided,
+                        coalesced_requests=task_queue.coalesced_requests,
+                        deadline_expired_jobs=task_queue.deadline_expired_jobs, deadline_saved_seconds=task_queue.deadline_saved_seconds,
+                        preempted_jobs=task_queue.preempted_jobs, preempt_overhead_seconds=task_queue.preempt_overhead_seconds,
+                        estimated_wait_seconds=task_queue.get_projected_wait(), estimated_finish_millis=estimated_finish_millis)
+
+
+@app.post("/v1/generation/cancel", response_model=AsyncJobResponse, description="Cancel a waiting or running job")
+def cancel_job(req: CancelJobRequest=Depends()):
+    queue_task = task_queue.cancel_task(req.job_id)
+    if queue_task is None:
+        return Response(content="Job not found", status_code=404)
+
+    return generation_output(queue_task, streaming_output=False, require_base64=False)
 
 
 @app.post("/v1/generation/stop", response_model=StopResponse, description="Job stoping")
@@ -1,9 +1,17 @@
-from typing import List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import os
+import numpy as np
+from typing import Callable, Dict, List
 
 from fastapi import Response
-from fooocusapi.file_utils import get_file_serve_url, output_file_to_base64img, output_file_to_bytesimg
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse
+from fooocusapi.file_utils import get_file_serve_url, get_output_file_path, output_file_to_base64img
 from fooocusapi.img_utils import read_input_image
-from fooocusapi.models import AsyncJobResponse, AsyncJobStage, GeneratedImageResult, GenerationFinishReason, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, Text2ImgRequest
+from fooocusapi.models import AsyncJobResponse, AsyncJobStage, GeneratedImageResult, GenerationFinishReason, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, JobStatus, Text2ImgRequest
 from fooocusapi.models_v2 import *
 from fooocusapi.parameters import ImageGenerationParams, ImageGenerationResult, default_inpaint_engine_version, default_sampler, default_scheduler, default_base_model_name, default_refiner_model_name
 from fooocusapi.task_queue import QueueTask
@@ -13,6 +21,17 @@ from modules import config
 from modules.sdxl_styles import legal_style_names
 
 
+# Decoding input images and encoding outputs, bounded so a burst of requests queues instead of spawning threads
+codec_executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 4, 8), thread_name_prefix="codec")
+
+
+async def run_codec(func: Callable, *args, **kwargs) -> any:
+    """
+    Run CPU heavy `func` in the codec executor, off the event loop
+    """
+    return await asyncio.get_running_loop().run_in_executor(codec_executor, functools.partial(func, *args, **kwargs))
+
+
 def req_to_params(req: Text2ImgRequest) -> ImageGenerationParams:
     if req.base_model_name is not None:
         if req.base_model_name not in config.model_filenames:
@@ -148,55 +167,129 @@ def req_to_params(req: Text2ImgRequest) -> ImageGenerationParams:
                                  )
 
 
+def params_to_coalesce_key(params: ImageGenerationParams) -> str | None:
+    """
+    Canonical hash of the resolved params, including the input image bytes
+    :returns: The hash, or None if the generation is not deterministic (random seed)
+    """
+    if params.image_seed is None or params.image_seed == -1:
+        return None
+
+    hasher = hashlib.sha256()
+
+    def update(value):
+        if isinstance(value, np.ndarray):
+            hasher.update(f'ndarray{value.shape}{value.dtype}'.encode())
+            hasher.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, dict):
+            hasher.update(b'{')
+            for k in sorted(value.keys()):
+                update(k)
+                update(value[k])
+            hasher.update(b'}')
+        elif isinstance(value, (list, tuple)):
+            hasher.update(b'[')
+            for v in value:
+                update(v)
+            hasher.update(b']')
+        else:
+            hasher.update(repr(value).encode())
+        hasher.update(b',')
+
+    update(params.__dict__)
+    return hasher.hexdigest()
+
+
+def get_job_stage(task: QueueTask) -> AsyncJobStage:
+    job_stage = AsyncJobStage.running
+    if task.start_millis == 0:
+        job_stage = AsyncJobStage.waiting
+    if task.is_finished:
+        if task.finish_with_error:
+            job_stage = AsyncJobStage.error
+        elif task.task_result != None:
+            job_stage = AsyncJobStage.success
+    return job_stage
+
+
+def get_job_result(task: QueueTask) -> List[GeneratedImageResult] | None:
+    # Cancelled or failed jobs keep the images finished before, split jobs show finished parts while running
+    if task.task_result != None and (len(task.task_result) > 0 or (task.is_finished and not task.finish_with_error)):
+        task_result_require_base64 = False
+        if 'require_base64' in task.req_param and task.req_param['require_base64']:
+            task_result_require_base64 = True
+
+        return generation_output(task.task_result, False, task_result_require_base64)
+    return None
+
+
+def job_status_output(task: QueueTask, require_result: bool) -> JobStatus:
+    """
+    Lean status of a job, the result is only built if required
+    """
+    return JobStatus(job_id=task.job_id,
+                     job_stage=get_job_stage(task),
+                     job_progress=task.finish_progress,
+                     job_status=task.task_status,
+                     job_version=task.events.version,
+                     job_result=get_job_result(task) if require_result else None)
+
+
 def generation_output(results: QueueTask | List[ImageGenerationResult], streaming_output: bool, require_base64: bool, require_step_preivew: bool=False) -> Response | List[GeneratedImageResult] | AsyncJobResponse:
     if isinstance(results, QueueTask):
         task = results
-        job_stage = AsyncJobStage.running
-        job_result = None
-        if task.start_millis == 0:
-            job_stage = AsyncJobStage.waiting
-        if task.is_finished:
-            if task.finish_with_error:
-                job_stage = AsyncJobStage.error
-            else:
-                if task.task_result != None:
-                    job_stage = AsyncJobStage.success
-                    task_result_require_base64 = False
-                    if 'require_base64' in task.req_param and task.req_param['require_base64']:
-                        task_result_require_base64 = True
-
-                    job_result = generation_output(task.task_result, False, task_result_require_base64)
-        job_step_preview = None if not require_step_preivew else task.task_step_preview
+        job_stage = get_job_stage(task)
+        job_result = get_job_result(task)
+        job_step_preview = None if not require_step_preivew else task.get_step_preview()
         return AsyncJobResponse(job_id=task.job_id,
                                 job_type=task.type,
                                 job_stage=job_stage,
                                 job_progress=task.finish_progress,
                                 job_status=task.task_status,
                                 job_step_preview=job_step_preview,
-                                job_result=job_result)
+                                job_result=job_result,
+                                job_estimated_start_millis=None if task.is_finished else task.estimated_start_millis,
+                                job_estimated_finish_millis=None if task.is_finished else task.estimated_finish_millis)
 
     if streaming_output:
         if len(results) == 0:
             return Response(status_code=500)
         result = results[0]
         if result.finish_reason == GenerationFinishReason.queue_is_full:
-            return Response(status_code=409, content=result.finish_reason.value)
+            return Response(status_code=409, content=result.finish_reason.value, headers=retry_after_headers(result))
         elif result.finish_reason == GenerationFinishReason.user_cancel:
             return Response(status_code=400, content=result.finish_reason.value)
+        elif result.finish_reason == GenerationFinishReason.deadline_exceeded:
+            return Response(status_code=408, content=result.finish_reason.value)
         elif result.finish_reason == GenerationFinishReason.error:
             return Response(status_code=500, content=result.finish_reason.value)
         
-        bytes = output_file_to_bytesimg(results[0].im)
-        return Response(bytes, media_type='image/png')
+        # Served from the saved file without encoding it again
+        file_path = get_output_file_path(results[0].im)
+        if file_path is None:
+            return Response(status_code=404)
+        return FileResponse(file_path, media_type='image/png')
     else:
-        results = [GeneratedImageResult(
-            base64=output_file_to_base64img(
-                item.im) if require_base64 else None,
-            url=get_file_serve_url(item.im),
-            seed=item.seed,
-            finish_reason=item.finish_reason) for item in results]
+        headers = retry_after_headers(results[0]) if len(results) > 0 else None
+        results = [result_to_output(item, require_base64) for item in results]
+        if headers is not None:
+            return JSONResponse(content=jsonable_encoder(results), headers=headers)
         return results
 
 
+def result_to_output(item: ImageGenerationResult, require_base64: bool) -> GeneratedImageResult:
+    return GeneratedImageResult(
+        base64=output_file_to_base64img(item.im) if require_base64 else None,
+        url=get_file_serve_url(item.im),
+        seed=item.seed,
+        finish_reason=item.finish_reason)
+
+
+def retry_after_headers(result: ImageGenerationResult) -> Dict[str, str] | None:
+    if result.finish_reason != GenerationFinishReason.queue_is_full or result.retry_after is None:
+        return None
+    return {'Retry-After': str(result.retry_after)}
+
+
 class QueueReachLimitException(Exception):
     pass
@@ -13,4 +13,19 @@ def add_base_args(parser: ArgumentParser, before_prepared: bool):
     parser.add_argument("--preload-pipeline", default=False, action="store_true", help="Preload pipeline before start http server")
     parser.add_argument("--queue-size", type=int, default=3, help="Working queue size, default: 3, generation requests exceeding working queue size will return failure")
     parser.add_argument("--queue-history", type=int, default=100, help="Finished jobs reserve size, tasks exceeding the limit will be deleted, including output image files, default: 100")
-    parser.add_argument('--webhook-url', type=str, default=None, help='The URL to send a POST request when a job is finished')
\ No newline at end of file
+    parser.add_argument("--queue-max-wait", type=float, default=None, help="Max projected seconds a new job waits in queue, computed from the estimated cost of queued jobs, generation requests exceeding it will return failure, replaces --queue-size if set, default: None")
+    parser.add_argument("--output-max-age", type=float, default=None, help="Delete output files older than this many hours, default: None (keep)")
+    parser.add_argument("--output-max-size", type=float, default=None, help="Delete the oldest output files when they use more than this many GB, default: None (no limit)")
+    parser.add_argument("--batch-split-size", type=int, default=0, help="Split jobs with more images into sub-jobs of this many images, so they interleave with other jobs in queue, 0 for disable, default: 0")
+    parser.add_argument("--preemption", default=False, action="store_true", help="Suspend running jobs of lower priority at the next image boundary when jobs of higher priority are waiting, they resume later without generating finished images again. Jobs are only suspended between images, so a single image job always runs to the end")
+    parser.add_argument("--checkpoint-max-memory", type=float, default=1024, help="Max MB of host memory for the prepared prompts of suspended jobs, default: 1024")
+    parser.add_argument("--client-weights", type=str, default=None, help="Comma separated client_id=weight for fair share scheduling, clients are identified by the X-Client-Id header, a client of weight 2 gets twice the GPU time of a client of weight 1 in the same priority, default: None (all clients have weight 1)")
+    parser.add_argument("--affinity-max-skips", type=int, default=3, help="Max times a waiting job can be bypassed by jobs using the loaded models to avoid model swaps, 0 for disable, default: 3")
+    parser.add_argument("--gpu-device-ids", type=str, default=None, help="Comma separated GPU device ids, start one engine worker for each device, default: None (use --gpu-device-id)")
+    parser.add_argument("--dispatch-mode", type=str, default='affinity', choices=['affinity', 'least-loaded'], help="How to dispatch jobs to engine workers, 'affinity' prefers workers with the job's models loaded, default: affinity")
+    parser.add_argument("--in-process-engine", default=False, action="store_true", help="Run the inference engine in the api server process instead of a child process for each device")
+    parser.add_argument("--job-store", type=str, default=None, help="SQLite database file to persist job queue and history across restarts, default: None (in memory only)")
+    parser.add_argument('--webhook-url', type=str, default=None, help='The URL to send a POST request when a job is finished')
+    parser.add_argument("--webhook-spool", type=str, default=None, help="Directory to keep webhook notifications until delivered, they are sent again after restart, default: None")
+    parser.add_argument("--webhook-batch-size", type=int, default=1, help="Max job notifications sent in one webhook POST as {\"jobs\": [...]}, default: 1 (one job per POST)")
+    parser.add_argument("--webhook-timeout", type=float, default=10, help="Timeout seconds of webhook requests, failed requests are retried with backoff, default: 10")
\ No newline at end of file
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from typing import List
+
+import torch
+
+
+def move_to_device(value: any, device: str) -> any:
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {k: move_to_device(v, device) for k, v in value.items()}
+    if isinstance(value, list):
+        return [move_to_device(v, device) for v in value]
+    if isinstance(value, tuple):
+        return tuple(move_to_device(v, device) for v in value)
+    return value
+
+
+def get_tensor_bytes(value: any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, dict):
+        return sum(get_tensor_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_tensor_bytes(v) for v in value)
+    return 0
+
+
+class CheckpointStore(object):
+    """
+    Keeps the prepared prompts (expansion and encoded conditioning) of preempted tasks in host memory,
+    so a resumed task skips prompt expansion and text encoding.
+    The total size is capped by `max_bytes`, the oldest checkpoints are dropped first, a resumed task
+    without its checkpoint prepares the prompts again.
+    """
+
+    def __init__(self, max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # job_id -> (prepared prompts of the remaining images, bytes)
+        self.checkpoints: OrderedDict[str, tuple] = OrderedDict()
+        self.total_bytes = 0
+
+    def put(self, job_id: str, tasks: List[dict]):
+        """
+        :param tasks: Prompt tasks of `process_generate` for the images not generated yet
+        """
+        self.discard(job_id)
+        prepared = [dict(expansion=t['expansion'], positive=t['positive'],
+                         c=move_to_device(t['c'], 'cpu'), uc=move_to_device(t['uc'], 'cpu')) for t in tasks]
+        size = get_tensor_bytes(prepared)
+        if size > self.max_bytes:
+            print(f"[Preemption] Checkpoint of {size} bytes exceeds the limit, job_id={job_id}")
+            return
+        while self.total_bytes + size > self.max_bytes and len(self.checkpoints) > 0:
+            dropped_job_id = next(iter(self.checkpoints))
+            print(f"[Preemption] Drop checkpoint for memory limit, job_id={dropped_job_id}")
+            self.discard(dropped_job_id)
+        self.checkpoints[job_id] = (prepared, size)
+        self.total_bytes += size
+
+    def take(self, job_id: str) -> List[dict] | None:
+        item = self.checkpoints.pop(job_id, None)
+        if item is None:
+            return None
+        self.total_bytes -= item[1]
+        return item[0]
+
+    def discard(self, job_id: str):
+        self.take(job_id)
@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import List, Tuple
+
+from fooocusapi.parameters import ImageGenerationResult
+from fooocusapi.task_queue import QueueTask, TaskQueue
+
+
+class EngineWorker(object):
+    """
+    A consumer of TaskQueue which runs generation tasks on one device, subclasses implement `run_task`
+    """
+
+    def __init__(self, worker_id: int, device_id: str | None = None):
+        self.worker_id = worker_id
+        self.device_id = device_id
+        # Dispatch state, managed by TaskQueue under its lock
+        self.online = False
+        self.running_task: QueueTask | None = None
+        self.pending_task: QueueTask | None = None
+        self.loaded_model_signature: Tuple | None = None
+        self.completed_tasks = 0
+        self.busy_millis = 0
+
+    def is_idle(self) -> bool:
+        return self.online and self.running_task is None
+
+    def run_task(self, task: QueueTask) -> List[ImageGenerationResult]:
+        raise NotImplementedError()
+
+    def cancel_task(self, task: QueueTask):
+        """
+        The task has `cancel_requested` set, engines running it in another process need to forward it
+        """
+        pass
+
+    def preempt_task(self, task: QueueTask):
+        """
+        The task has `preempt_requested` set, engines running it in another process need to forward it
+        """
+        pass
+
+    def interrupt(self):
+        """
+        Ask the running task to stop at the next sampling step
+        """
+        pass
+
+
+def complete_task(task_queue: TaskQueue, task: QueueTask, results: List[ImageGenerationResult]):
+    """
+    Finish the task run by a worker, or queue it again if it was preempted
+    """
+    if task.checkpoint is not None and not task.finish_with_error:
+        # Preempted, the task is waiting again
+        task_queue.suspend_task(task.job_id)
+        print(f"[Task Queue] Suspend task, job_id={task.job_id}")
+    else:
+        task_queue.finish_task(task.job_id)
+        if task.finish_with_error:
+            print(f"[Task Queue] Finish task with error, job_id={task.job_id}")
+        else:
+            print(f"[Task Queue] Finish task, job_id={task.job_id}")
+        task.future.set_result(results)
+
+
+def engine_loop(task_queue: TaskQueue, worker: EngineWorker):
+    while True:
+        task = None
+        results = []
+        try:
+            task = task_queue.wait_next_task(worker)
+            print(f"[Task Queue] Start task, job_id={task.job_id}, worker={worker.worker_id}")
+            results = worker.run_task(task)
+        except Exception as e:
+            print('Worker error:', e)
+            if task is None:
+                # Dispatch failed, keep the worker alive and try again
+                time.sleep(1)
+            else:
+                task.set_result([], True, str(e))
+        finally:
+            if task is not None:
+                complete_task(task_queue, task, results)
+
+
+def start_engine_workers(task_queue: TaskQueue, workers: List[EngineWorker]) -> List[threading.Thread]:
+    threads = []
+    for worker in workers:
+        task_queue.register_worker(worker)
+        thread = threading.Thread(target=engine_loop, args=(task_queue, worker),
+                                  name=f"engine_worker_{worker.worker_id}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -0,0 +1,314 @@
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from typing import List
+
+import numpy as np
+
+from fooocusapi.engine import EngineWorker
+from fooocusapi.parameters import ImageGenerationParams, ImageGenerationResult
+from fooocusapi.task_queue import QueueTask, TaskType
+
+
+# Size of the shared memory slot for step preview images, larger previews are dropped
+preview_slot_size = 16 * 1024 * 1024
+
+# Byte 0 of the preview slot, the child only writes a free slot and the parent frees it after reading
+preview_slot_free = 0
+preview_slot_full = 1
+
+
+class SharedArray(object):
+    """
+    Describes a ndarray copied into a shared memory segment, it's sent through the pipe instead of the array bytes
+    """
+
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def share_arrays(value: any, segments: List[shared_memory.SharedMemory]) -> any:
+    """
+    Replace every ndarray in value with a SharedArray, created segments are appended to `segments`
+    """
+    if isinstance(value, np.ndarray):
+        segment = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        segments.append(segment)
+        np.ndarray(value.shape, dtype=value.dtype, buffer=segment.buf)[...] = value
+        return SharedArray(segment.name, value.shape, value.dtype.str)
+    if isinstance(value, dict):
+        return {k: share_arrays(v, segments) for k, v in value.items()}
+    if isinstance(value, list):
+        return [share_arrays(v, segments) for v in value]
+    if isinstance(value, tuple):
+        return tuple(share_arrays(v, segments) for v in value)
+    return value
+
+
+def attach_arrays(value: any) -> any:
+    """
+    Inverse of `share_arrays` in the engine process
+    """
+    if isinstance(value, SharedArray):
+        segment = shared_memory.SharedMemory(name=value.name)
+        try:
+            # The pipeline keeps module level references to input images (e.g. inpaint_worker.current_task),
+            # so they must own their memory, the segment is released by the parent after the task
+            return np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=segment.buf).copy()
+        finally:
+            segment.close()
+    if isinstance(value, dict):
+        return {k: attach_arrays(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [attach_arrays(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(attach_arrays(v) for v in value)
+    return value
+
+
+def release_segments(segments: List[shared_memory.SharedMemory]):
+    for segment in segments:
+        try:
+            segment.close()
+            segment.unlink()
+        except Exception as e:
+            print('[Engine Process] Release shared memory error:', e)
+    segments.clear()
+
+
+class ProcessEngineWorker(EngineWorker):
+    """
+    Runs tasks in a child process which owns the pipeline and the device.
+    Input images and step previews are moved through shared memory, result images are saved to the
+    output folder by the child and only the filenames are sent back.
+    If the child dies, the running task fails and a new child is started.
+    """
+
+    def __init__(self, worker_id: int, device_id: str | None = None, argv: List[str] | None = None):
+        super().__init__(worker_id, device_id)
+        self.argv = list(sys.argv if argv is None else argv)
+        self.process: multiprocessing.Process | None = None
+        self.conn: Connection | None = None
+        self.preview_slot: shared_memory.SharedMemory | None = None
+        self.send_lock = threading.Lock()
+        # Entry of the child process, with the arguments of `engine_process_main`
+        self.process_main = engine_process_main
+
+    def start_process(self):
+        context = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = context.Pipe()
+        self.preview_slot = shared_memory.SharedMemory(create=True, size=preview_slot_size)
+        self.preview_slot.buf[0] = preview_slot_free
+        self.process = context.Process(target=self.process_main,
+                                       args=(child_conn, self.device_id, self.argv, self.preview_slot.name),
+                                       name=f"engine_process_{self.worker_id}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        print(f"[Engine Process] Started engine process {self.process.pid}, worker={self.worker_id}, device={self.device_id}")
+
+    def stop_process(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                try:
+                    self.send(('stop',))
+                except (OSError, ValueError):
+                    pass
+                self.process.join(timeout=5)
+                if self.process.is_alive():
+                    self.process.kill()
+            self.process = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.preview_slot is not None:
+            release_segments([self.preview_slot])
+            self.preview_slot = None
+
+    def send(self, message: tuple):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def run_task(self, task: QueueTask) -> List[ImageGenerationResult]:
+        if self.process is None or not self.process.is_alive():
+            self.stop_process()
+            self.start_process()
+
+        segments = []
+        try:
+            params = share_arrays(task.params.__dict__, segments)
+            # The checkpoint is consumed by this run, a new one is sent back if it's preempted again
+            checkpoint, task.checkpoint = task.checkpoint, None
+            self.send(('run', task.job_id, task.type.value, params, task.deadline_millis, checkpoint))
+            while True:
+                if not self.conn.poll(1.0):
+                    if not self.process.is_alive():
+                        raise RuntimeError(f"Engine process exited with code {self.process.exitcode}")
+                    continue
+
+                message = self.conn.recv()
+                if message[0] == 'progress':
+                    _, _, progress, status, step, total_steps, preview = message
+                    preview_image = None
+                    if preview is not None:
+                        shape, dtype = preview
+                        preview_image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.preview_slot.buf, offset=1).copy()
+                        self.preview_slot.buf[0] = preview_slot_free
+                    task.set_progress(progress, status, step, total_steps, preview_image)
+                elif message[0] == 'partial':
+                    task.set_partial_result(message[2])
+                elif message[0] == 'result':
+                    _, _, results, finish_with_error, error_message, timings, checkpoint = message
+                    task.set_timings(timings)
+                    if checkpoint is not None:
+                        task.set_checkpoint(checkpoint)
+                    else:
+                        task.set_result(results, finish_with_error, error_message)
+                    return results
+        except (EOFError, OSError, RuntimeError) as e:
+            print(f"[Engine Process] Engine process failed, worker={self.worker_id}:", e)
+            self.stop_process()
+            self.start_process()
+            raise RuntimeError(f"Engine process failed: {e}")
+        finally:
+            release_segments(segments)
+
+    def cancel_task(self, task: QueueTask):
+        if self.conn is not None:
+            try:
+                self.send(('cancel', task.job_id))
+            except (OSError, ValueError):
+                pass
+
+    def preempt_task(self, task: QueueTask):
+        if self.conn is not None:
+            try:
+                self.send(('preempt', task.job_id))
+            except (OSError, ValueError):
+                pass
+
+    def interrupt(self):
+        if self.conn is not None:
+            try:
+                self.send(('interrupt',))
+            except (OSError, ValueError):
+                pass
+
+
+class EngineProcessTask(QueueTask):
+    """
+    Stand-in for the parent's QueueTask in the engine process, progress is forwarded through the pipe
+    """
+
+    def __init__(self, job_id: str, type: TaskType, params: ImageGenerationParams,
+                 conn: Connection, preview_slot: shared_memory.SharedMemory):
+        super().__init__(job_id, type, {}, 0, params)
+        self.conn = conn
+        self.preview_slot = preview_slot
+
+    def set_progress(self, progress: int, status: str | None, step: int | None = None, total_steps: int | None = None,
+                     preview_image: np.ndarray | None = None):
+        super().set_progress(progress, status, step, total_steps)
+        preview = None
+        # Drop the preview if the previous one is not consumed yet
+        if preview_image is not None and preview_image.nbytes + 1 <= self.preview_slot.size \
+                and self.preview_slot.buf[0] == preview_slot_free:
+            np.ndarray(preview_image.shape, dtype=preview_image.dtype, buffer=self.preview_slot.buf, offset=1)[...] = preview_image
+            self.preview_slot.buf[0] = preview_slot_full
+            preview = (preview_image.shape, preview_image.dtype.str)
+        self.conn.send(('progress', self.job_id, self.finish_progress, self.task_status, step, total_steps, preview))
+
+    def set_partial_result(self, task_result: List[ImageGenerationResult]):
+        super().set_partial_result(task_result)
+        self.conn.send(('partial', self.job_id, task_result))
+
+
+def engine_process_main(conn: Connection, device_id: str | None, argv: List[str], preview_slot_name: str):
+    """
+    Entry of the engine process, it must select the device before torch is imported
+    """
+    if device_id is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(device_id)
+    sys.argv = argv
+
+    from fooocusapi.args import args
+    from fooocusapi.worker import checkpoint_store, process_generate
+    import ldm_patched.modules.model_management as model_management
+
+    try:
+        import modules.default_pipeline as _
+    except Exception as e:
+        print('Import default pipeline error:', e)
+
+    checkpoint_store.max_bytes = int(args.checkpoint_max_memory * 1024 * 1024)
+    preview_slot = shared_memory.SharedMemory(name=preview_slot_name)
+    run_queue = queue.Queue()
+    running = {'task': None}
+    cancelled_job_ids = set()
+    preempted_job_ids = set()
+
+    def read_loop():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                # Parent is gone
+                run_queue.put(None)
+                return
+            if message[0] == 'run':
+                run_queue.put(message)
+            elif message[0] == 'cancel':
+                # The task may not be started yet
+                cancelled_job_ids.add(message[1])
+                task = running['task']
+                if task is not None and task.job_id == message[1]:
+                    task.cancel_requested = True
+            elif message[0] == 'preempt':
+                preempted_job_ids.add(message[1])
+                task = running['task']
+                if task is not None and task.job_id == message[1]:
+                    task.preempt_requested = True
+            elif message[0] == 'interrupt':
+                model_management.interrupt_current_processing()
+            elif message[0] == 'stop':
+                run_queue.put(None)
+                return
+
+    threading.Thread(target=read_loop, name="engine_process_reader", daemon=True).start()
+
+    while True:
+        message = run_queue.get()
+        if message is None:
+            break
+        _, job_id, type_value, params_dict, deadline_millis, checkpoint = message
+        params = ImageGenerationParams.__new__(ImageGenerationParams)
+        params.__dict__.update(attach_arrays(params_dict))
+        task = EngineProcessTask(job_id, TaskType(type_value), params, conn, preview_slot)
+        task.deadline_millis = deadline_millis
+        task.checkpoint = checkpoint
+        running['task'] = task
+        if job_id in cancelled_job_ids:
+            task.cancel_requested = True
+        if job_id in preempted_job_ids:
+            task.preempt_requested = True
+        # An interrupt for the previous task may arrive after it finished
+        model_management.interrupt_current_processing(False)
+        try:
+            process_generate(task, params)
+        except Exception as e:
+            print('Worker error:', e)
+            task.set_result([], True, str(e))
+        running['task'] = None
+        cancelled_job_ids.discard(job_id)
+        preempted_job_ids.discard(job_id)
+        conn.send(('result', job_id, task.task_result, task.finish_with_error, task.error_message, task.timings,
+                   task.checkpoint))
+
+    preview_slot.close()
+    conn.close()
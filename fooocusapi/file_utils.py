@@ -1,7 +1,9 @@
 import base64
+from collections import OrderedDict
 import datetime
-from io import BytesIO
 import os
+import threading
+from typing import List
 import numpy as np
 from PIL import Image
 import uuid
@@ -12,6 +14,12 @@ os.makedirs(output_dir, exist_ok=True)
 
 static_serve_base_url = 'http://127.0.0.1:8888/files/'
 
+# Recently encoded base64 strings of output files, so polling a finished job doesn't encode its images again
+base64_cache: OrderedDict[str, str] = OrderedDict()
+base64_cache_max_bytes = 64 * 1024 * 1024
+base64_cache_bytes = 0
+base64_cache_lock = threading.Lock()
+
 
 def save_output_file(img: np.ndarray) -> str:
     current_time = datetime.datetime.now()
@@ -25,43 +33,68 @@ def save_output_file(img: np.ndarray) -> str:
     return filename
 
 
-def delete_output_file(filename: str):
+def forget_base64_cache(filenames: List[str], dir_name: str | None = None):
+    """
+    Drop the cached base64 strings of deleted output files
+    :param dir_name: Also drop the files in this deleted date directory
+    """
+    global base64_cache_bytes
+    with base64_cache_lock:
+        if dir_name is not None:
+            prefix = dir_name + os.sep
+            filenames = filenames + [f for f in base64_cache if f.startswith(prefix)]
+        for filename in filenames:
+            dropped = base64_cache.pop(filename, None)
+            if dropped is not None:
+                base64_cache_bytes -= len(dropped)
+
+
+def get_output_file_path(filename: str | None) -> str | None:
+    """
+    Path of the output file, None if it doesn't exist
+    """
+    if filename is None:
+        return None
     file_path = os.path.join(output_dir, filename)
     if not os.path.exists(file_path) or not os.path.isfile(file_path):
-        return
-    try:
-        os.remove(file_path)
-    except OSError:
-        print(f"Delete output file failed: {filename}")
+        return None
+    return file_path
 
 
 def output_file_to_base64img(filename: str | None) -> str | None:
-    if filename is None:
-        return None
-    file_path = os.path.join(output_dir, filename)
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
+    global base64_cache_bytes
+    # Checked before the cache, the file may be deleted
+    file_path = get_output_file_path(filename)
+    if file_path is None:
         return None
 
-    img = Image.open(file_path)
-    output_buffer = BytesIO()
-    img.save(output_buffer, format='PNG')
-    byte_data = output_buffer.getvalue()
-    base64_str = base64.b64encode(byte_data)
+    with base64_cache_lock:
+        base64_str = base64_cache.get(filename)
+        if base64_str is not None:
+            base64_cache.move_to_end(filename)
+            return base64_str
+
+    # Output files are saved as PNG, the stored bytes are sent as they are
+    with open(file_path, 'rb') as f:
+        base64_str = base64.b64encode(f.read()).decode('ascii')
+
+    with base64_cache_lock:
+        if filename not in base64_cache and len(base64_str) <= base64_cache_max_bytes:
+            base64_cache[filename] = base64_str
+            base64_cache_bytes += len(base64_str)
+            while base64_cache_bytes > base64_cache_max_bytes:
+                _, dropped = base64_cache.popitem(last=False)
+                base64_cache_bytes -= len(dropped)
     return base64_str
 
 
 def output_file_to_bytesimg(filename: str | None) -> bytes | None:
-    if filename is None:
-        return None
-    file_path = os.path.join(output_dir, filename)
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
+    file_path = get_output_file_path(filename)
+    if file_path is None:
         return None
 
-    img = Image.open(file_path)
-    output_buffer = BytesIO()
-    img.save(output_buffer, format='PNG')
-    byte_data = output_buffer.getvalue()
-    return byte_data
+    with open(file_path, 'rb') as f:
+        return f.read()
 
 
 def get_file_serve_url(filename: str | None) -> str | None:
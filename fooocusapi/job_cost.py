@@ -0,0 +1,207 @@
+import math
+import re
+import threading
+from typing import Dict, Tuple
+
+from fooocusapi.parameters import ImageGenerationParams
+
+
+# Seconds of one SDXL sampling step at 1024*1024 on the reference device, other costs are relative to it
+reference_step_seconds = 0.25
+reference_pixels = 1024 * 1024
+
+# Prompt expansion and text encoding of a job, VAE decoding and saving of each image
+job_overhead_seconds = 2.0
+image_overhead_seconds = 1.0
+
+# Relative extra cost of each sampling step for each ControlNet (PyraCanny, CPDS) and image prompt adapter
+controlnet_step_factor = 0.35
+ip_adapter_step_factor = 0.1
+
+# Swapping between base and refiner models in the middle of sampling
+refiner_swap_seconds = 3.0
+
+# Upscaler model pass per megapixel of the input image
+upscale_seconds_per_megapixel = 1.5
+
+# Indexes in ImageGenerationParams.advanced_params
+advanced_sampler_name = 5
+advanced_overwrite_step = 8
+advanced_overwrite_width = 10
+advanced_overwrite_height = 11
+
+
+def get_advanced_param(params: ImageGenerationParams, index: int, default: any) -> any:
+    if params.advanced_params is None or len(params.advanced_params) <= index:
+        return default
+    return params.advanced_params[index]
+
+
+def get_job_steps(params: ImageGenerationParams, upscale: bool = False) -> int:
+    """
+    Sampling steps of each image, the same as `process_generate` resolves them
+    """
+    if upscale:
+        steps = {'Speed': 18, 'Quality': 36, 'Extreme Speed': 8}.get(params.performance_selection, 18)
+    else:
+        steps = {'Speed': 30, 'Quality': 60, 'Extreme Speed': 8}.get(params.performance_selection, 30)
+    overwrite_step = get_advanced_param(params, advanced_overwrite_step, -1)
+    if overwrite_step > 0:
+        steps = overwrite_step
+    return steps
+
+
+def get_job_sampler(params: ImageGenerationParams) -> str | None:
+    if params.performance_selection == 'Extreme Speed':
+        return 'lcm'
+    return get_advanced_param(params, advanced_sampler_name, None)
+
+
+def get_job_controlnets(params: ImageGenerationParams) -> Tuple[int, int]:
+    """
+    :returns: Count of ControlNet image prompts (PyraCanny, CPDS) and image prompt adapters
+    """
+    controlnets = len([p for p in params.image_prompts if p[3] in ('PyraCanny', 'CPDS')])
+    return controlnets, len(params.image_prompts) - controlnets
+
+
+def get_step_factor(controlnets: int, ip_adapters: int) -> float:
+    return 1.0 + controlnets * controlnet_step_factor + ip_adapters * ip_adapter_step_factor
+
+
+def get_upscale_factor(params: ImageGenerationParams) -> float:
+    if params.upscale_value is not None:
+        return params.upscale_value
+    matches = re.findall(r"([0-9]+(?:\.[0-9]+)?)x", params.uov_method.lower())
+    if len(matches) > 0:
+        return min(max(float(matches[0]), 1.0), 5.0)
+    return 1.0
+
+
+def get_job_resolution(params: ImageGenerationParams) -> Tuple[int, int, str | None]:
+    """
+    :returns: Width and height of the sampled images, and the uov goal ('vary', 'upscale', 'fast_upscale' or None)
+    """
+    width, height = [int(v) for v in re.findall(r"\d+", params.aspect_ratios_selection)[:2]]
+
+    goal = None
+    uov_method = params.uov_method.lower()
+    if params.uov_input_image is not None and uov_method != 'disabled':
+        input_height, input_width = params.uov_input_image.shape[:2]
+        if 'vary' in uov_method:
+            goal = 'vary'
+            # The image is resized into [1024, 2048] shape ceil
+            scale = min(max(math.sqrt(input_width * input_height), 1024), 2048) / math.sqrt(input_width * input_height)
+            width, height = int(input_width * scale), int(input_height * scale)
+        elif 'upscale' in uov_method:
+            f = get_upscale_factor(params)
+            width, height = int(input_width * f), int(input_height * f)
+            goal = 'fast_upscale' if 'fast' in uov_method or math.sqrt(width * height) > 2800 else 'upscale'
+
+    overwrite_width = get_advanced_param(params, advanced_overwrite_width, -1)
+    overwrite_height = get_advanced_param(params, advanced_overwrite_height, -1)
+    if goal is None and overwrite_width > 0:
+        width = overwrite_width
+    if goal is None and overwrite_height > 0:
+        height = overwrite_height
+    return width, height, goal
+
+
+def estimate_job_cost(params: ImageGenerationParams | None, throughput: 'ThroughputEstimator | None' = None) -> float:
+    """
+    Estimated GPU-seconds of a job, on the reference device or from the measured throughput if given
+    """
+    job_seconds = job_overhead_seconds
+    image_seconds = image_overhead_seconds
+    if throughput is not None:
+        job_seconds = throughput.prepare_seconds or job_seconds
+        image_seconds = throughput.image_seconds or image_seconds
+    if params is None:
+        return job_seconds + image_seconds
+
+    width, height, goal = get_job_resolution(params)
+    if goal in ('upscale', 'fast_upscale'):
+        input_height, input_width = params.uov_input_image.shape[:2]
+        upscale_seconds = upscale_seconds_per_megapixel * input_width * input_height / 1e6
+        if throughput is not None:
+            upscale_seconds *= throughput.speed_factor
+        if goal == 'fast_upscale':
+            # The upscaled image is returned directly, only one image is produced
+            return job_seconds + upscale_seconds + image_seconds
+    else:
+        upscale_seconds = 0.0
+
+    steps = get_job_steps(params, upscale=goal == 'upscale')
+    controlnets, ip_adapters = get_job_controlnets(params)
+    if throughput is not None:
+        step_seconds = throughput.get_step_seconds(params.base_model_name, width, height, get_job_sampler(params),
+                                                   controlnets, ip_adapters)
+    else:
+        step_seconds = reference_step_seconds * width * height / reference_pixels * get_step_factor(controlnets, ip_adapters)
+
+    image_seconds += steps * step_seconds
+    use_refiner = params.performance_selection != 'Extreme Speed' and params.refiner_model_name != 'None' \
+        and params.refiner_model_name != params.base_model_name and params.refiner_switch < 1.0
+    if use_refiner:
+        image_seconds += refiner_swap_seconds
+
+    return job_seconds + upscale_seconds + image_seconds * max(params.image_number, 1)
+
+
+class ThroughputEstimator(object):
+    """
+    Online estimate of generation speed from the timings measured by the workers.
+    Step rates are kept for each (model, resolution, sampler, controlnets) seen, other combinations are scaled
+    from the reference costs by the measured speed factor of the device.
+    """
+
+    def __init__(self, smoothing: float = 0.2):
+        # Weight of a new measurement in the moving averages
+        self.smoothing = smoothing
+        self.step_seconds: Dict[Tuple, float] = {}
+        # Measured time relative to the reference device
+        self.speed_factor = 1.0
+        self.measured = False
+        self.prepare_seconds: float | None = None
+        self.image_seconds: float | None = None
+        self.lock = threading.Lock()
+
+    def moving_average(self, average: float | None, value: float) -> float:
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def record(self, timings: dict):
+        """
+        :param timings: Measured by `process_generate`, with keys model, width, height, sampler, controlnets,
+            ip_adapters, steps, sampling_seconds, prepare_seconds, images and image_seconds
+        """
+        with self.lock:
+            if timings.get('prepare_seconds') is not None:
+                self.prepare_seconds = self.moving_average(self.prepare_seconds, timings['prepare_seconds'])
+            if timings.get('images', 0) > 0:
+                self.image_seconds = self.moving_average(self.image_seconds, timings['image_seconds'] / timings['images'])
+            if timings.get('steps', 0) <= 0:
+                return
+
+            step_seconds = timings['sampling_seconds'] / timings['steps']
+            key = (timings['model'], timings['width'], timings['height'], timings['sampler'],
+                   timings['controlnets'], timings['ip_adapters'])
+            self.step_seconds[key] = self.moving_average(self.step_seconds.get(key), step_seconds)
+
+            reference_seconds = reference_step_seconds * timings['width'] * timings['height'] / reference_pixels \
+                * get_step_factor(timings['controlnets'], timings['ip_adapters'])
+            speed_factor = step_seconds / reference_seconds
+            self.speed_factor = self.moving_average(self.speed_factor if self.measured else None, speed_factor)
+            self.measured = True
+
+    def get_step_seconds(self, model: str, width: int, height: int, sampler: str | None,
+                         controlnets: int, ip_adapters: int) -> float:
+        step_seconds = self.step_seconds.get((model, width, height, sampler, controlnets, ip_adapters))
+        if step_seconds is not None:
+            return step_seconds
+        return reference_step_seconds * width * height / reference_pixels \
+            * get_step_factor(controlnets, ip_adapters) * self.speed_factor
+
+    def estimate_job_cost(self, params: ImageGenerationParams | None) -> float:
+        return estimate_job_cost(params, self)
@@ -0,0 +1,227 @@
+import json
+import pickle
+import queue
+import sqlite3
+import threading
+from typing import Dict, List
+
+from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
+
+
+job_status_waiting = 'WAITING'
+job_status_running = 'RUNNING'
+job_status_success = 'SUCCESS'
+job_status_error = 'ERROR'
+
+
+def get_job_status(task) -> str:
+    if task.is_finished:
+        return job_status_error if task.finish_with_error else job_status_success
+    return job_status_waiting if task.start_millis == 0 else job_status_running
+
+
+def task_to_record(task, params_data: bytes | None = None) -> dict:
+    """
+    Snapshot the metadata of a QueueTask, the serialized generation params are only stored for new tasks
+    because they can be large (input images)
+    """
+    req_param = {k: v for k, v in task.req_param.items() if k != 'params'}
+    task_result = None
+    if isinstance(task.task_result, List):
+        task_result = [{'im': item.im, 'seed': item.seed, 'finish_reason': item.finish_reason.value}
+                       for item in task.task_result if isinstance(item, ImageGenerationResult)]
+    record = {
+        'job_id': task.job_id,
+        'job_type': task.type.value,
+        'status': get_job_status(task),
+        'priority': task.priority.value,
+        'client_id': task.client_id,
+        'in_queue_millis': task.in_queue_millis,
+        'start_millis': task.start_millis,
+        'finish_millis': task.finish_millis,
+        'finish_progress': task.finish_progress,
+        'task_status': task.task_status,
+        'error_message': task.error_message,
+        'req_param': json.dumps(req_param),
+        'task_result': None if task_result is None else json.dumps(task_result),
+        'deadline_millis': task.deadline_millis,
+        'coalesce_key': task.coalesce_key,
+        'params': params_data,
+    }
+    return record
+
+
+def record_to_results(record: dict) -> List[ImageGenerationResult] | None:
+    if record['task_result'] is None:
+        return None
+    return [ImageGenerationResult(im=item['im'], seed=item['seed'], finish_reason=GenerationFinishReason(item['finish_reason']))
+            for item in json.loads(record['task_result'])]
+
+
+class JobStore(object):
+    """
+    Persistence layer for QueueTask metadata, this default store keeps nothing
+    """
+
+    def dump_params(self, params) -> bytes | None:
+        return None
+
+    def save_task(self, task, params_data: bytes | None = None):
+        pass
+
+    def delete_tasks(self, job_ids: List[str]):
+        pass
+
+    def load_unfinished_tasks(self) -> List[dict]:
+        return []
+
+    def load_finished_tasks(self, limit: int) -> List[dict]:
+        return []
+
+    def close(self):
+        pass
+
+
+class SqliteJobStore(JobStore):
+    """
+    Job store on a SQLite database in WAL mode.
+    Writes are queued and group committed by a background thread, so callers never wait on disk.
+    """
+
+    columns = ['job_id', 'job_type', 'status', 'priority', 'client_id', 'in_queue_millis', 'start_millis',
+               'finish_millis', 'finish_progress', 'task_status', 'error_message', 'req_param', 'task_result',
+               'deadline_millis', 'coalesce_key']
+
+    # Columns added after the first schema, as (name, type)
+    added_columns = [('deadline_millis', 'INTEGER'), ('coalesce_key', 'TEXT')]
+
+    def __init__(self, path: str, batch_size: int = 256):
+        self.path = path
+        self.batch_size = batch_size
+        self.write_queue: queue.Queue = queue.Queue()
+
+        conn = self.connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                job_type TEXT NOT NULL,
+                status TEXT NOT NULL,
+                priority TEXT NOT NULL,
+                client_id TEXT NOT NULL,
+                in_queue_millis INTEGER NOT NULL,
+                start_millis INTEGER NOT NULL,
+                finish_millis INTEGER NOT NULL,
+                finish_progress INTEGER NOT NULL,
+                task_status TEXT,
+                error_message TEXT,
+                req_param TEXT NOT NULL,
+                task_result TEXT,
+                params BLOB,
+                deadline_millis INTEGER,
+                coalesce_key TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE INDEX IF NOT EXISTS jobs_finish_millis ON jobs (finish_millis);
+        ''')
+        self.migrate(conn)
+        conn.close()
+
+        self.writer_thread = threading.Thread(target=self.write_loop, name="job_store_writer", daemon=True)
+        self.writer_thread.start()
+
+    def migrate(self, conn: sqlite3.Connection):
+        """
+        Add the columns missing in a database created by an older version
+        """
+        existing = [row['name'] for row in conn.execute('PRAGMA table_info(jobs)')]
+        with conn:
+            for name, column_type in self.added_columns:
+                if name not in existing:
+                    print(f"[Job Store] Add column {name} to jobs table")
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {name} {column_type}')
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def dump_params(self, params) -> bytes | None:
+        return None if params is None else pickle.dumps(params)
+
+    def save_task(self, task, params_data: bytes | None = None):
+        self.write_queue.put(('save', task_to_record(task, params_data)))
+
+    def delete_tasks(self, job_ids: List[str]):
+        if len(job_ids) > 0:
+            self.write_queue.put(('delete', job_ids))
+
+    def write_loop(self):
+        conn = self.connect()
+        column_names = ', '.join(self.columns)
+        placeholders = ', '.join(f':{c}' for c in self.columns)
+        updates = ', '.join(f'{c}=excluded.{c}' for c in self.columns if c != 'job_id')
+        upsert_sql = f'INSERT INTO jobs ({column_names}, params) VALUES ({placeholders}, :params) ' \
+                     f'ON CONFLICT(job_id) DO UPDATE SET {updates}'
+        # Params are only needed to recover unfinished jobs
+        finished_sql = 'UPDATE jobs SET params=NULL WHERE job_id=:job_id'
+
+        while True:
+            batch = [self.write_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            try:
+                with conn:
+                    for action, value in batch:
+                        if action == 'save':
+                            conn.execute(upsert_sql, value)
+                            if value['status'] in (job_status_success, job_status_error):
+                                conn.execute(finished_sql, value)
+                        elif action == 'delete':
+                            conn.executemany('DELETE FROM jobs WHERE job_id=?', [(job_id,) for job_id in value])
+                        elif action == 'stop':
+                            stop = True
+            except Exception as e:
+                print('[Job Store] Write error:', e)
+            finally:
+                for _ in batch:
+                    self.write_queue.task_done()
+
+            if stop:
+                conn.close()
+                return
+
+    def load_unfinished_tasks(self) -> List[dict]:
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY in_queue_millis",
+                                (job_status_waiting, job_status_running)).fetchall()
+            return [self.row_to_record(row) for row in rows]
+        finally:
+            conn.close()
+
+    def load_finished_tasks(self, limit: int) -> List[dict]:
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY finish_millis DESC LIMIT ?",
+                                (job_status_success, job_status_error, limit)).fetchall()
+            return [self.row_to_record(row) for row in reversed(rows)]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def row_to_record(row: sqlite3.Row) -> Dict:
+        record = dict(row)
+        if record['params'] is not None:
+            record['params'] = pickle.loads(record['params'])
+        return record
+
+    def close(self):
+        self.write_queue.put(('stop', None))
+        self.writer_thread.join()
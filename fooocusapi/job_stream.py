@@ -0,0 +1,159 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, List, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from fooocusapi.api_utils import generation_output, result_to_output, run_codec
+from fooocusapi.file_utils import output_file_to_bytesimg
+from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
+from fooocusapi.progress_events import ProgressEvent
+from fooocusapi.task_queue import QueueTask
+
+
+# Seconds between heartbeats when a job has no progress, so proxies keep the connection and gone clients are noticed
+heartbeat_seconds = 15
+
+
+def job_snapshot(task: QueueTask) -> dict:
+    return jsonable_encoder(generation_output(task, streaming_output=False, require_base64=False))
+
+
+async def job_event_stream(task: QueueTask, preview_interval_ms: int | None = None) -> AsyncIterator[Tuple[str, dict | None]]:
+    """
+    Events of a job as (event name, data):
+    'job' with the job state at start, 'progress' for each progress event, with 'step_preview' if
+    previews are requested and `preview_interval_ms` passed since the last one, 'heartbeat' when idle,
+    and 'result' with the final job state, which ends the stream.
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def on_event(event: ProgressEvent):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    for event in task.events.subscribe(on_event, task.events.sequence):
+        events.put_nowait(event)
+    try:
+        # Encoding the job output reads result files, keep it off the event loop
+        if task.is_finished:
+            yield 'result', await run_codec(job_snapshot, task)
+            return
+        yield 'job', await run_codec(job_snapshot, task)
+
+        last_preview_millis = 0
+        while True:
+            try:
+                event: ProgressEvent = await asyncio.wait_for(events.get(), heartbeat_seconds)
+            except asyncio.TimeoutError:
+                yield 'heartbeat', None
+                continue
+
+            if event.is_final():
+                yield 'result', await run_codec(job_snapshot, task)
+                return
+
+            data = event.to_dict()
+            now_millis = int(round(time.time() * 1000))
+            if event.preview and preview_interval_ms is not None and now_millis - last_preview_millis >= preview_interval_ms:
+                data['step_preview'] = await run_codec(task.get_step_preview)
+                last_preview_millis = now_millis
+            yield 'progress', data
+    finally:
+        task.events.unsubscribe(on_event)
+
+
+async def wait_for_job_change(task: QueueTask, timeout: float) -> bool:
+    """
+    Wait on the event loop until the job publishes a progress event or the timeout passes
+    :returns: True if the job changed
+    """
+    loop = asyncio.get_running_loop()
+    changed = loop.create_future()
+
+    def set_changed():
+        if not changed.done():
+            changed.set_result(True)
+
+    def on_event(_: ProgressEvent):
+        loop.call_soon_threadsafe(set_changed)
+
+    buffered = task.events.subscribe(on_event, task.events.sequence)
+    try:
+        if len(buffered) > 0 or task.is_finished:
+            return True
+        await asyncio.wait_for(changed, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        task.events.unsubscribe(on_event)
+
+
+async def sse_job_stream(task: QueueTask, preview_interval_ms: int | None = None) -> AsyncIterator[str]:
+    async for event, data in job_event_stream(task, preview_interval_ms):
+        if data is None:
+            yield ": heartbeat\n\n"
+        else:
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def job_result_stream(task: QueueTask) -> AsyncIterator[ImageGenerationResult]:
+    """
+    Results of a job, each image as soon as it's finished, results without image when the job is finished
+    """
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def on_event(_: ProgressEvent):
+        loop.call_soon_threadsafe(changed.set)
+
+    task.events.subscribe(on_event, task.events.sequence)
+    sent_files = set()
+    try:
+        while True:
+            # Cleared before reading the task, a change while sending sets it again
+            changed.clear()
+            is_finished = task.is_finished
+            results: List[ImageGenerationResult] = task.task_result if isinstance(task.task_result, List) else []
+            for item in list(results):
+                if item.im is not None and item.finish_reason == GenerationFinishReason.success:
+                    if item.im not in sent_files:
+                        sent_files.add(item.im)
+                        yield item
+                elif is_finished:
+                    yield item
+            if is_finished:
+                return
+            await changed.wait()
+    finally:
+        task.events.unsubscribe(on_event)
+
+
+async def multipart_result_stream(task: QueueTask, boundary: str) -> AsyncIterator[bytes]:
+    """
+    Body of a multipart/mixed response, a PNG part for each image and a JSON part for each result without image,
+    or whose file is already deleted
+    """
+    async for item in job_result_stream(task):
+        content = None
+        if item.im is not None:
+            content = await run_codec(output_file_to_bytesimg, item.im)
+            content_type = 'image/png'
+        if content is None:
+            content = json.dumps(jsonable_encoder(result_to_output(item, False))).encode('utf-8')
+            content_type = 'application/json'
+        headers = (f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Length: {len(content)}\r\n"
+                   f"X-Seed: {item.seed}\r\nX-Finish-Reason: {item.finish_reason.value}\r\n\r\n")
+        yield headers.encode('utf-8') + content + b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
+
+async def ndjson_result_stream(task: QueueTask, require_base64: bool) -> AsyncIterator[str]:
+    """
+    A JSON line for each result, in the same format as the application/json response
+    """
+    async for item in job_result_stream(task):
+        output = await run_codec(result_to_output, item, require_base64)
+        yield json.dumps(jsonable_encoder(output)) + "\n"
@@ -11,7 +11,7 @@ from typing import List
 from enum import Enum
 
 from fooocusapi.parameters import GenerationFinishReason, defualt_styles, default_base_model_name, default_refiner_model_name, default_refiner_switch, default_loras, default_cfg_scale, default_prompt_negative, default_aspect_ratio, default_sampler, default_scheduler
-from fooocusapi.task_queue import TaskType
+from fooocusapi.task_queue import TaskPriority, TaskType
 
 from modules import flags
 
@@ -117,6 +117,8 @@ class Text2ImgRequest(BaseModel):
     advanced_params: AdvancedParams | None = AdvancedParams()
     require_base64: bool = Field(default=False, description="Return base64 data of generated image")
     async_process: bool = Field(default=False, description="Set to true will run async and return job info for retrieve generataion result later")
+    priority: TaskPriority = Field(default=TaskPriority.normal, description="Scheduling priority, higher priority jobs always start first")
+    deadline_ms: int | None = Field(default=None, description="Give up the job if it's not finished in this many milliseconds after submit", gt=0)
 
 
 class ImgUpscaleOrVaryRequest(Text2ImgRequest):
@@ -146,6 +148,8 @@ class ImgUpscaleOrVaryRequest(Text2ImgRequest):
                 advanced_params: str | None = Form(default=None, description="Advanced parameters in JSON"),
                 require_base64: bool = Form(default=False, description="Return base64 data of generated image"),
                 async_process: bool = Form(default=False, description="Set to true will run async and return job info for retrieve generataion result later"),
+                priority: TaskPriority = Form(default=TaskPriority.normal, description="Scheduling priority, higher priority jobs always start first"),
+                deadline_ms: int | None = Form(default=None, description="Give up the job if it's not finished in this many milliseconds after submit", gt=0),
                 ):
         style_selection_arr: List[str] = []
         for part in style_selections:
@@ -174,7 +178,7 @@ class ImgUpscaleOrVaryRequest(Text2ImgRequest):
                    performance_selection=performance_selection, aspect_ratios_selection=aspect_ratios_selection,
                    image_number=image_number, image_seed=image_seed, sharpness=sharpness, guidance_scale=guidance_scale,
                    base_model_name=base_model_name, refiner_model_name=refiner_model_name, refiner_switch=refiner_switch,
-                   loras=loras_model, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process)
+                   loras=loras_model, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process, priority=priority, deadline_ms=deadline_ms)
 
 
 class ImgInpaintOrOutpaintRequest(Text2ImgRequest):
@@ -217,6 +221,8 @@ class ImgInpaintOrOutpaintRequest(Text2ImgRequest):
                 advanced_params: str| None = Form(default=None, description="Advanced parameters in JSON"),
                 require_base64: bool = Form(default=False, description="Return base64 data of generated image"),
                 async_process: bool = Form(default=False, description="Set to true will run async and return job info for retrieve generataion result later"),
+                priority: TaskPriority = Form(default=TaskPriority.normal, description="Scheduling priority, higher priority jobs always start first"),
+                deadline_ms: int | None = Form(default=None, description="Give up the job if it's not finished in this many milliseconds after submit", gt=0),
                 ):
 
         if isinstance(input_mask, File):
@@ -263,7 +269,7 @@ class ImgInpaintOrOutpaintRequest(Text2ImgRequest):
                    performance_selection=performance_selection, aspect_ratios_selection=aspect_ratios_selection,
                    image_number=image_number, image_seed=image_seed, sharpness=sharpness, guidance_scale=guidance_scale,
                    base_model_name=base_model_name, refiner_model_name=refiner_model_name, refiner_switch=refiner_switch,
-                   loras=loras_model, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process)
+                   loras=loras_model, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process, priority=priority, deadline_ms=deadline_ms)
 
 
 class ImgPromptRequest(Text2ImgRequest):
@@ -319,6 +325,8 @@ class ImgPromptRequest(Text2ImgRequest):
                 advanced_params: str| None = Form(default=None, description="Advanced parameters in JSON"),
                 require_base64: bool = Form(default=False, description="Return base64 data of generated image"),
                 async_process: bool = Form(default=False, description="Set to true will run async and return job info for retrieve generataion result later"),
+                priority: TaskPriority = Form(default=TaskPriority.normal, description="Scheduling priority, higher priority jobs always start first"),
+                deadline_ms: int | None = Form(default=None, description="Give up the job if it's not finished in this many milliseconds after submit", gt=0),
                 ):
         if isinstance(cn_img1, File):
             cn_img1 = None
@@ -364,7 +372,7 @@ class ImgPromptRequest(Text2ImgRequest):
                    performance_selection=performance_selection, aspect_ratios_selection=aspect_ratios_selection,
                    image_number=image_number, image_seed=image_seed, sharpness=sharpness, guidance_scale=guidance_scale,
                    base_model_name=base_model_name, refiner_model_name=refiner_model_name, refiner_switch=refiner_switch,
-                   loras=loras_model, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process)
+                   loras=loras_model, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process, priority=priority, deadline_ms=deadline_ms)
 
 
 class GeneratedImageResult(BaseModel):
@@ -385,6 +393,13 @@ class AsyncJobStage(str, Enum):
 class QueryJobRequest(BaseModel):
     job_id: str = Field(description="Job ID to query")
     require_step_preivew: bool = Field(False, description="Set to true will return preview image of generation steps at current time")
+    wait_for_change: bool = Field(False, description="Set to true will wait until the job's progress, stage or result changes, or until timeout, before return")
+    timeout: float = Field(30, gt=0, le=300, description="Max seconds to wait if wait_for_change is true")
+
+
+class StreamJobRequest(BaseModel):
+    job_id: str = Field(description="Job ID to stream")
+    preview_interval_ms: int | None = Field(None, ge=0, description="Send preview image of generation steps at most once in this many milliseconds, no preview if not set")
 
 
 class AsyncJobResponse(BaseModel):
@@ -395,12 +410,44 @@ class AsyncJobResponse(BaseModel):
     job_status: str | None = Field(None, description="Job running status in text")
     job_step_preview: str | None = Field(None, description="Preview image of generation steps at current time, as base64 image")
     job_result: List[GeneratedImageResult] | None = Field(None, description="Job generation result")
+    job_estimated_start_millis: int | None = Field(None, description="Estimated timestamp in milliseconds when the job starts, for waiting and running jobs")
+    job_estimated_finish_millis: int | None = Field(None, description="Estimated timestamp in milliseconds when the job finishes, for waiting and running jobs")
+
+
+class QueryJobsRequest(BaseModel):
+    job_ids: List[str] = Field(max_length=1000, description="Job IDs to query")
+    since_version: int | None = Field(None, ge=0, description="Only return jobs changed after this version, which is returned by the previous query")
+    require_result: bool = Field(False, description="Set to true will return generation results of the jobs")
+
+
+class JobStatus(BaseModel):
+    job_id: str = Field(description="Job ID")
+    job_stage: AsyncJobStage = Field(description="Job running stage")
+    job_progress: int = Field(description="Job running progress, 100 is for finished")
+    job_status: str | None = Field(None, description="Job running status in text")
+    job_version: int = Field(description="Version of the job's last change")
+    job_result: List[GeneratedImageResult] | None = Field(None, description="Job generation result, only if require_result is true")
+
+
+class QueryJobsResponse(BaseModel):
+    version: int = Field(description="Current version, pass it as since_version to get only jobs changed after this query")
+    jobs: List[JobStatus] = Field(description="Jobs changed since since_version, all found jobs if not set")
+    not_found: List[str] = Field(description="Job IDs not found")
 
 
 class JobQueueInfo(BaseModel):
     running_size: int = Field(description="The current running and waiting job count")
     finished_size: int = Field(description="Finished job cound (after auto clean)")
     last_job_id: str = Field(description="Last submit generation job id")
+    model_swaps: int = Field(0, description="How many times a job started with different models than the previous job")
+    model_swaps_avoided: int = Field(0, description="How many model swaps were avoided by running jobs using the loaded models first")
+    coalesced_requests: int = Field(0, description="How many requests were attached to an identical waiting or running job")
+    deadline_expired_jobs: int = Field(0, description="How many jobs were dropped or stopped because their deadline passed")
+    deadline_saved_seconds: float = Field(0, description="Estimated GPU-seconds saved by dropping or stopping jobs after their deadline")
+    preempted_jobs: int = Field(0, description="How many times a running job was suspended for a job with higher priority")
+    preempt_overhead_seconds: float = Field(0, description="Measured seconds of saving and resuming suspended jobs")
+    estimated_wait_seconds: float = Field(0, description="Estimated seconds a new job with normal priority waits before start")
+    estimated_finish_millis: int | None = Field(None, description="Estimated timestamp in milliseconds when all current jobs are finished")
 
 
 class AllModelNamesResponse(BaseModel):
@@ -411,5 +458,9 @@ class AllModelNamesResponse(BaseModel):
         protected_namespaces=('protect_me_', 'also_protect_')
     )
     
+class CancelJobRequest(BaseModel):
+    job_id: str = Field(description="Job ID to cancel")
+
+
 class StopResponse(BaseModel):
     msg: str
@@ -1,3 +1,5 @@
+from typing import Annotated, Literal, Union
+
 from fooocusapi.models import *
 
 
@@ -27,3 +29,31 @@ class ImagePromptJson(BaseModel):
 
 class ImgPromptRequestJson(Text2ImgRequest):
     image_prompts: List[ImagePromptJson | ImagePrompt]
+
+
+class Text2ImgBatchJob(Text2ImgRequest):
+    job_type: Literal[TaskType.text_2_img.value] = Field(description="Job type")
+
+
+class ImgUpscaleOrVaryBatchJob(ImgUpscaleOrVaryRequestJson):
+    job_type: Literal[TaskType.img_uov.value] = Field(description="Job type")
+
+
+class ImgInpaintOrOutpaintBatchJob(ImgInpaintOrOutpaintRequestJson):
+    job_type: Literal[TaskType.img_inpaint_outpaint.value] = Field(description="Job type")
+
+
+class ImgPromptBatchJob(ImgPromptRequestJson):
+    job_type: Literal[TaskType.img_prompt.value] = Field(description="Job type")
+
+
+BatchJob = Annotated[Union[Text2ImgBatchJob, ImgUpscaleOrVaryBatchJob, ImgInpaintOrOutpaintBatchJob, ImgPromptBatchJob],
+                     Field(discriminator='job_type')]
+
+
+class BatchGenerationRequest(BaseModel):
+    jobs: List[BatchJob] = Field(min_length=1, description="Jobs to submit, each with 'job_type' and the same fields as the v2 api of that type, jobs always run async")
+
+
+class BatchGenerationResponse(BaseModel):
+    job_ids: List[str] = Field(description="Job ID of each job in request order, identical jobs share a job ID")
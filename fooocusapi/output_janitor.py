@@ -0,0 +1,172 @@
+import datetime
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from fooocusapi.file_utils import forget_base64_cache, output_dir
+
+
+class OutputJanitor(object):
+    """
+    Deletes output files in a background thread, so finishing tasks never waits on the filesystem.
+    Output files live in `output_dir/<date>/`. Besides deleting files of tasks removed from history, it applies
+    retention by age and by total bytes, removing whole date directories where possible.
+    Directory sizes are cached and only directories changed since the last scan are scanned again.
+    """
+
+    def __init__(self, root_dir: str = output_dir, max_age_hours: float | None = None, max_bytes: int | None = None,
+                 interval_seconds: float = 60, protect_seconds: float = 600):
+        self.root_dir = root_dir
+        self.max_age_hours = max_age_hours
+        self.max_bytes = max_bytes
+        self.interval_seconds = interval_seconds
+        # Files newer than this are never deleted by the size limit, they may not be fetched yet
+        self.protect_seconds = protect_seconds
+
+        self.delete_queue: queue.Queue = queue.Queue()
+        # Date directory name -> (mtime at scan, total bytes)
+        self.dir_sizes: Dict[str, Tuple[float, int]] = {}
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="output_janitor", daemon=True)
+            self.thread.start()
+
+    def delete_files(self, filenames: List[str]):
+        """
+        Queue output files for deletion, filenames are relative to the root dir
+        """
+        if len(filenames) == 0:
+            return
+        self.start()
+        self.delete_queue.put(filenames)
+
+    def run(self):
+        next_sweep = time.monotonic()
+        while True:
+            timeout = max(next_sweep - time.monotonic(), 0)
+            try:
+                filenames = self.delete_queue.get(timeout=timeout)
+                # Take everything queued in one go
+                while True:
+                    try:
+                        filenames = filenames + self.delete_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self.remove_files(filenames)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print('[Output Janitor] Delete files error:', e)
+
+            if time.monotonic() >= next_sweep:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print('[Output Janitor] Sweep error:', e)
+                next_sweep = time.monotonic() + self.interval_seconds
+
+    def remove_files(self, filenames: List[str]):
+        forget_base64_cache(filenames)
+        for filename in filenames:
+            file_path = os.path.join(self.root_dir, filename)
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                self.deleted_files += 1
+                self.deleted_bytes += size
+            except FileNotFoundError:
+                pass
+            except OSError:
+                print(f"[Output Janitor] Delete output file failed: {filename}")
+
+    def list_date_dirs(self) -> List[str]:
+        """
+        Date directory names, the oldest first
+        """
+        if not os.path.isdir(self.root_dir):
+            return []
+        names = []
+        for entry in os.scandir(self.root_dir):
+            if entry.is_dir(follow_symlinks=False):
+                try:
+                    datetime.datetime.strptime(entry.name, "%Y-%m-%d")
+                except ValueError:
+                    continue
+                names.append(entry.name)
+        return sorted(names)
+
+    def get_dir_size(self, name: str) -> int:
+        dir_path = os.path.join(self.root_dir, name)
+        mtime = os.stat(dir_path).st_mtime
+        cached = self.dir_sizes.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        size = 0
+        for entry in os.scandir(dir_path):
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+        self.dir_sizes[name] = (mtime, size)
+        return size
+
+    def remove_dir(self, name: str, size: int):
+        print(f"[Output Janitor] Remove output directory: {name}")
+        shutil.rmtree(os.path.join(self.root_dir, name), ignore_errors=True)
+        forget_base64_cache([], name)
+        self.dir_sizes.pop(name, None)
+        self.deleted_bytes += size
+
+    def sweep(self):
+        if self.max_age_hours is None and self.max_bytes is None:
+            return
+        names = self.list_date_dirs()
+        for name in [n for n in self.dir_sizes if n not in names]:
+            del self.dir_sizes[name]
+
+        if self.max_age_hours is not None:
+            expire_time = datetime.datetime.now() - datetime.timedelta(hours=self.max_age_hours)
+            expire_date = expire_time.strftime("%Y-%m-%d")
+            while len(names) > 0 and names[0] < expire_date:
+                # The whole day is older than the limit
+                self.remove_dir(names[0], self.dir_sizes.get(names[0], (0, 0))[1])
+                names.pop(0)
+            if len(names) > 0 and names[0] == expire_date:
+                self.remove_old_files(names[0], expire_time.timestamp())
+
+        if self.max_bytes is not None:
+            sizes = [self.get_dir_size(name) for name in names]
+            total = sum(sizes)
+            while total > self.max_bytes and len(names) > 1:
+                self.remove_dir(names[0], sizes[0])
+                total -= sizes.pop(0)
+                names.pop(0)
+            if total > self.max_bytes and len(names) == 1:
+                self.remove_old_files(names[0], time.time() - self.protect_seconds, total - self.max_bytes)
+
+    def remove_old_files(self, name: str, before_timestamp: float, max_remove_bytes: int | None = None):
+        """
+        Delete files in the date directory modified before the timestamp, the oldest first
+        :param max_remove_bytes: Stop after removing this many bytes
+        """
+        dir_path = os.path.join(self.root_dir, name)
+        files = []
+        for entry in os.scandir(dir_path):
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime < before_timestamp:
+                    files.append((stat.st_mtime, stat.st_size, entry.name))
+        removed_bytes = 0
+        for _, size, filename in sorted(files):
+            if max_remove_bytes is not None and removed_bytes >= max_remove_bytes:
+                break
+            self.remove_files([os.path.join(name, filename)])
+            removed_bytes += size
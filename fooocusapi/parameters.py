@@ -67,14 +67,17 @@ class GenerationFinishReason(str, Enum):
     success = 'SUCCESS'
     queue_is_full = 'QUEUE_IS_FULL'
     user_cancel = 'USER_CANCEL'
+    deadline_exceeded = 'DEADLINE_EXCEEDED'
     error = 'ERROR'
 
 
 class ImageGenerationResult(object):
-    def __init__(self, im: str | None, seed: str, finish_reason: GenerationFinishReason):
+    def __init__(self, im: str | None, seed: str, finish_reason: GenerationFinishReason, retry_after: int | None = None):
         self.im = im
         self.seed = seed
         self.finish_reason = finish_reason
+        # Seconds to wait before retry, for queue_is_full
+        self.retry_after = retry_after
 
 
 class ImageGenerationParams(object):
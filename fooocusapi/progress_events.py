@@ -0,0 +1,118 @@
+from collections import deque
+from enum import Enum
+import threading
+import time
+from typing import Callable, Deque, List
+
+
+# Version of the latest event of all jobs, clients use it to ask for jobs changed since their last query
+version_lock = threading.Lock()
+last_version = 0
+
+
+def get_current_version() -> int:
+    with version_lock:
+        return last_version
+
+
+class ProgressStage(str, Enum):
+    waiting = 'WAITING'
+    running = 'RUNNING'
+    suspended = 'SUSPENDED'
+    success = 'SUCCESS'
+    error = 'ERROR'
+
+
+class ProgressEvent(object):
+    """
+    A change of a job's state. Preview images are not kept in events, `preview` tells a new step preview
+    is available from the task, `images` is the number of finished images when it changed.
+    """
+
+    def __init__(self, sequence: int, stage: ProgressStage, progress: int, status: str | None,
+                 step: int | None = None, total_steps: int | None = None, preview: bool = False,
+                 timings: dict | None = None, images: int | None = None):
+        self.sequence = sequence
+        self.millis = int(round(time.time() * 1000))
+        self.stage = stage
+        self.progress = progress
+        self.status = status
+        self.step = step
+        self.total_steps = total_steps
+        self.preview = preview
+        self.timings = timings
+        self.images = images
+
+    def is_final(self) -> bool:
+        return self.stage in (ProgressStage.success, ProgressStage.error)
+
+    def to_dict(self) -> dict:
+        return {
+            "sequence": self.sequence,
+            "millis": self.millis,
+            "stage": self.stage.value,
+            "progress": self.progress,
+            "status": self.status,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "preview": self.preview,
+            "timings": self.timings,
+            "images": self.images,
+        }
+
+
+class ProgressEvents(object):
+    """
+    Bounded ring buffer of a job's progress events, older events are dropped.
+    Subscribers are called with each new event in the publishing thread, they must return quickly,
+    e.g. by handing the event over to an event loop.
+    """
+
+    def __init__(self, max_events: int = 64):
+        self.events: Deque[ProgressEvent] = deque(maxlen=max_events)
+        self.sequence = 0
+        # Global version of the latest event, 0 if none
+        self.version = 0
+        self.subscribers: List[Callable[[ProgressEvent], None]] = []
+        self.lock = threading.Lock()
+
+    def publish(self, stage: ProgressStage, progress: int, status: str | None,
+                step: int | None = None, total_steps: int | None = None, preview: bool = False,
+                timings: dict | None = None, images: int | None = None) -> ProgressEvent:
+        global last_version
+        with self.lock:
+            self.sequence += 1
+            event = ProgressEvent(self.sequence, stage, progress, status, step, total_steps, preview, timings, images)
+            self.events.append(event)
+            with version_lock:
+                last_version += 1
+                self.version = last_version
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print('[Progress Events] Subscriber error:', e)
+        return event
+
+    def subscribe(self, callback: Callable[[ProgressEvent], None], after_sequence: int = 0) -> List[ProgressEvent]:
+        """
+        Call `callback` with each new event until unsubscribed
+        :returns: Buffered events after `after_sequence`, no event is missed between them and the callbacks
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+            return [e for e in self.events if e.sequence > after_sequence]
+
+    def unsubscribe(self, callback: Callable[[ProgressEvent], None]):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def get_events(self, after_sequence: int = 0) -> List[ProgressEvent]:
+        with self.lock:
+            return [e for e in self.events if e.sequence > after_sequence]
+
+    def get_last_event(self) -> ProgressEvent | None:
+        with self.lock:
+            return self.events[-1] if len(self.events) > 0 else None
@@ -1,13 +1,28 @@
+from collections import OrderedDict, deque
+import copy
+from concurrent.futures import Future
 from enum import Enum
+import itertools
+import json
+import math
+import random
+import threading
 import time
 import numpy as np
 import uuid
-from typing import List, Tuple
-import requests
-from fooocusapi.file_utils import delete_output_file, get_file_serve_url
+from typing import TYPE_CHECKING, Deque, Dict, List, Tuple
+from fooocusapi.file_utils import get_file_serve_url
 
 from fooocusapi.img_utils import narray_to_base64img
-from fooocusapi.parameters import ImageGenerationResult, GenerationFinishReason
+from fooocusapi.job_cost import ThroughputEstimator, estimate_job_cost, get_job_resolution
+from fooocusapi.job_store import JobStore, job_status_error, record_to_results
+from fooocusapi.output_janitor import OutputJanitor
+from fooocusapi.parameters import ImageGenerationParams, ImageGenerationResult, GenerationFinishReason
+from fooocusapi.progress_events import ProgressEvents, ProgressStage
+from fooocusapi.webhook import WebhookDispatcher
+
+if TYPE_CHECKING:
+    from fooocusapi.engine import EngineWorker
 
 
 class TaskType(str, Enum):
@@ -17,6 +32,67 @@ class TaskType(str, Enum):
     img_prompt = 'Image Prompt'
 
 
+class TaskPriority(str, Enum):
+    high = 'High'
+    normal = 'Normal'
+    low = 'Low'
+
+
+# Lower rank is scheduled first
+task_priority_rank = {
+    TaskPriority.high: 0,
+    TaskPriority.normal: 1,
+    TaskPriority.low: 2,
+}
+
+default_client_id = 'default'
+
+
+def parse_client_weights(value: str | None) -> Dict[str, float]:
+    """
+    Parse comma separated `client_id=weight` items, e.g. 'web=4,batch=0.5'
+    """
+    weights = {}
+    if value is None:
+        return weights
+    for item in value.split(','):
+        if len(item.strip()) == 0:
+            continue
+        client_id, _, weight = item.partition('=')
+        if len(client_id.strip()) == 0 or float(weight) <= 0:
+            raise ValueError(f"Invalid client weight: {item}")
+        weights[client_id.strip()] = float(weight)
+    return weights
+
+task_sequence = itertools.count()
+
+# Same as Fooocus modules.constants.MAX_SEED
+max_seed = 2 ** 63 - 1
+
+
+def is_deadline_exceeded(task: 'QueueTask') -> bool:
+    """
+    Whether the task was dropped or stopped because its deadline passed
+    """
+    return isinstance(task.task_result, List) and any(
+        isinstance(item, ImageGenerationResult) and item.finish_reason == GenerationFinishReason.deadline_exceeded
+        for item in task.task_result)
+
+
+def get_model_signature(params: ImageGenerationParams | None) -> Tuple | None:
+    """
+    The models `pipeline.refresh_everything` will load for the params, jobs with equal signature need no model swap
+    """
+    if params is None:
+        return None
+    extreme_speed = params.performance_selection == 'Extreme Speed'
+    refiner_model_name = params.refiner_model_name
+    if extreme_speed or refiner_model_name == params.base_model_name:
+        refiner_model_name = 'None'
+    loras = tuple((name, weight) for name, weight in params.loras if name != 'None')
+    return params.base_model_name, refiner_model_name, loras, extreme_speed
+
+
 class QueueTask(object):
     job_id: str
     is_finished: bool = False
@@ -26,23 +102,143 @@ class QueueTask(object):
     finish_with_error: bool = False
     task_status: str | None = None
     task_step_preview: str | None = None
+    step_preview_image: np.ndarray | None = None
     task_result: any = None
     error_message: str | None = None
+    timings: dict | None = None
+    cancel_requested: bool = False
+    preempt_requested: bool = False
+    checkpoint: dict | None = None
+    estimated_start_millis: int | None = None
+    estimated_finish_millis: int | None = None
 
-    def __init__(self, job_id: str, type: TaskType, req_param: dict, in_queue_millis: int):
+    def __init__(self, job_id: str, type: TaskType, req_param: dict, in_queue_millis: int,
+                 params: ImageGenerationParams | None = None,
+                 priority: TaskPriority = TaskPriority.normal, client_id: str = default_client_id,
+                 deadline_millis: int | None = None):
         self.job_id = job_id
         self.type = type
         self.req_param = req_param
         self.in_queue_millis = in_queue_millis
+        self.params = params
+        self.priority = priority
+        self.client_id = client_id
+        # Timestamp in milliseconds after which nobody waits for the result
+        self.deadline_millis = deadline_millis
+        # Submit order, breaks ties between equal fair share tags
+        self.sequence = next(task_sequence)
+        # Virtual start and finish time for weighted fair queuing between clients
+        self.fair_start_tag = 0.0
+        self.fair_finish_tag = 0.0
+        # How many times this task was bypassed by a task using the loaded models
+        self.affinity_skips = 0
+        self.model_signature = get_model_signature(params)
+        # Estimated GPU-seconds, used for admission and fair share
+        self.estimated_cost = estimate_job_cost(params)
+        # The engine worker running this task
+        self.worker: 'EngineWorker | None' = None
+        # Identical deterministic requests share this task, see `TaskQueue.add_task`
+        self.coalesce_key: str | None = None
+        # Resolved with the generation results when the task is finished
+        self.future: Future = Future()
+        # A large batch is split into sub-tasks, which are scheduled instead of it and aggregated into it
+        self.parent: QueueTask | None = None
+        self.sub_tasks: List[QueueTask] = []
+        # Recent progress events, for transports pushing progress to clients
+        self.events = ProgressEvents()
 
-    def set_progress(self, progress: int, status: str | None):
+    def is_deadline_passed(self) -> bool:
+        return self.deadline_millis is not None and time.time() * 1000 > self.deadline_millis
+
+    def fair_share_cost(self) -> float:
+        return self.estimated_cost
+
+    def remaining_cost(self) -> float:
+        if self.start_millis == 0:
+            return self.estimated_cost
+        elapsed_seconds = (time.time() * 1000 - self.start_millis) / 1000
+        return max(self.estimated_cost - elapsed_seconds, self.estimated_cost * (100 - self.finish_progress) / 100)
+
+    def set_progress(self, progress: int, status: str | None, step: int | None = None, total_steps: int | None = None,
+                     preview_image: np.ndarray | None = None):
         if progress > 100:
             progress = 100
         self.finish_progress = progress
         self.task_status = status
+        if preview_image is not None:
+            self.set_step_preview_image(preview_image)
+        self.events.publish(ProgressStage.running, progress, status, step, total_steps, preview_image is not None)
+        if self.parent is not None:
+            self.parent.update_from_sub_tasks(preview_image is not None)
+
+    def publish_finished(self, timings: dict | None = None):
+        self.events.publish(ProgressStage.error if self.finish_with_error else ProgressStage.success,
+                            self.finish_progress, self.task_status, timings=timings)
+
+    def update_from_sub_tasks(self, preview: bool = False) -> bool:
+        """
+        Aggregate progress and results of the sub-tasks, results of finished sub-tasks are available at once
+        :returns: True if all sub-tasks are finished
+        """
+        finished_tasks = [t for t in self.sub_tasks if t.is_finished]
+        self.finish_progress = int(sum(t.finish_progress for t in self.sub_tasks) / len(self.sub_tasks))
+        self.task_status = f'{len(finished_tasks)}/{len(self.sub_tasks)} parts finished'
+        results = []
+        for t in self.sub_tasks:
+            if isinstance(t.task_result, List):
+                results += t.task_result
+        if len(finished_tasks) < len(self.sub_tasks):
+            self.task_result = results
+            self.events.publish(ProgressStage.running, self.finish_progress, self.task_status, preview=preview,
+                                images=len(results))
+            return False
+
+        error_tasks = [t for t in self.sub_tasks if t.finish_with_error]
+        self.set_result(results, len(error_tasks) > 0, error_tasks[0].error_message if len(error_tasks) > 0 else None)
+        return True
+
+    def set_partial_result(self, task_result: List[ImageGenerationResult]):
+        """
+        Images finished so far by the running task, they are delivered before the rest of the batch
+        """
+        self.task_result = task_result
+        self.events.publish(ProgressStage.running, self.finish_progress, self.task_status, images=len(task_result))
+        if self.parent is not None:
+            self.parent.update_from_sub_tasks()
 
     def set_step_preview(self, task_step_preview: str | None):
         self.task_step_preview = task_step_preview
+        self.step_preview_image = None
+
+    def set_step_preview_image(self, image: np.ndarray | None):
+        """
+        Keep the raw preview image, it's only encoded when someone asks for it
+        """
+        self.step_preview_image = image
+
+    def get_step_preview(self) -> str | None:
+        for t in self.sub_tasks:
+            if t.start_millis > 0 and not t.is_finished:
+                return t.get_step_preview()
+        image = self.step_preview_image
+        if image is not None:
+            self.task_step_preview = narray_to_base64img(image)
+            self.step_preview_image = None
+        return self.task_step_preview
+
+    def set_timings(self, timings: dict | None):
+        """
+        Record the measured timings of the generation, see `ThroughputEstimator.record`
+        """
+        self.timings = timings
+
+    def set_checkpoint(self, checkpoint: dict):
+        """
+        The task was preempted at an image boundary and will resume from the checkpoint
+        :param checkpoint: Made by `process_generate`, with keys seed, next_index and results
+        """
+        self.checkpoint = checkpoint
+        self.task_result = checkpoint['results']
 
     def set_result(self, task_result: any, finish_with_error: bool, error_message: str | None = None):
         if not finish_with_error:
@@ -54,103 +250,785 @@ class QueueTask(object):
 
 
 class TaskQueue(object):
-    queue: List[QueueTask] = []
-    history: List[QueueTask] = []
     last_job_id = None
     webhook_url: str | None = None
 
-    def __init__(self, queue_size: int, hisotry_size: int, webhook_url: str | None = None):
+    def __init__(self, queue_size: int, hisotry_size: int, webhook_url: str | None = None, affinity_max_skips: int = 3,
+                 queue_max_wait: float | None = None):
         self.queue_size = queue_size
+        # Max projected seconds a new task waits before start, replaces the `queue_size` limit if set
+        self.queue_max_wait = queue_max_wait
         self.history_size = hisotry_size
         self.webhook_url = webhook_url
+        # How many times a waiting task can be bypassed in favour of the loaded models, 0 for disable
+        self.affinity_max_skips = affinity_max_skips
+
+        # Waiting and running tasks in submit order, keyed by job_id
+        self.queue: OrderedDict[str, QueueTask] = OrderedDict()
+        # Finished tasks, the oldest is on the left side
+        self.history: Deque[QueueTask] = deque()
+        self.history_index: Dict[str, QueueTask] = {}
+        self.lock = threading.RLock()
+        self.task_added = threading.Condition(self.lock)
+
+        # Weight of each client for fair share scheduling, 1.0 if not set, see `parse_client_weights`
+        self.client_weights: Dict[str, float] = {}
+        # Weighted fair queuing state, one virtual clock per priority
+        self.virtual_time: Dict[TaskPriority, float] = {}
+        self.client_finish_tags: Dict[Tuple[TaskPriority, str], float] = {}
 
-    def add_task(self, type: TaskType, req_param: dict) -> QueueTask | None:
+        # Engine workers and how to dispatch tasks to them, 'affinity' or 'least-loaded'
+        self.workers: List['EngineWorker'] = []
+        self.dispatch_mode = 'affinity'
+        self.model_swaps = 0
+        self.model_swaps_avoided = 0
+
+        # Jobs with more images are split into sub-tasks of this many images, 0 for disable
+        self.batch_split_size = 0
+        # Unfinished split tasks by job_id, only their sub-tasks are in `queue`
+        self.parent_tasks: Dict[str, QueueTask] = {}
+
+        # Unfinished tasks by coalesce key
+        self.coalesce_index: Dict[str, QueueTask] = {}
+        self.coalesced_requests = 0
+
+        # Tasks dropped or stopped after their deadline, and their estimated GPU-seconds not spent
+        self.deadline_expired_jobs = 0
+        self.deadline_saved_seconds = 0.0
+        # Expires waiting tasks while all workers are busy, started with the first task having a deadline
+        self.deadline_sweeper: threading.Thread | None = None
+
+        # Running tasks of lower priority are suspended at the next image for waiting tasks of higher priority
+        self.preemption = False
+        self.preempted_jobs = 0
+        # Measured seconds of saving checkpoints and preparing resumed tasks again
+        self.preempt_overhead_seconds = 0.0
+
+        self.job_store = JobStore()
+        self.throughput = ThroughputEstimator()
+        # Changed with the queue and the throughput estimate, the estimated times are computed again after a change
+        self.queue_version = 0
+        self.estimated_times: Dict[str, Tuple[int, int]] = {}
+        self.estimated_times_version = -1
+        self.estimated_times_millis = 0
+        # Running tasks progress without changing the queue, their estimates are refreshed after this long
+        self.estimated_times_max_age_millis = 1000
+        # Deletes output files of tasks removed from history and applies output retention
+        self.output_janitor = OutputJanitor()
+        # Delivers webhook notifications, created for `webhook_url` on first use if not set
+        self.webhook_dispatcher: WebhookDispatcher | None = None
+
+    def add_task(self, type: TaskType, req_param: dict, params: ImageGenerationParams | None = None,
+                 priority: TaskPriority = TaskPriority.normal, client_id: str | None = None,
+                 coalesce_key: str | None = None, deadline_millis: int | None = None) -> QueueTask | None:
         """
         Create and add task to queue
-        :returns: The created task's job_id, or None if reach the queue size limit
+        :param coalesce_key: Canonical hash of a deterministic request, if a waiting or running task has the same key,
+            the request is attached to that task instead of creating a new one
+        :param deadline_millis: Timestamp in milliseconds, the task is dropped if it's still waiting then
+        :returns: The created or attached task, or None if reach the queue size limit or the projected wait limit
+        """
+        tasks = self.add_tasks([dict(type=type, req_param=req_param, params=params, priority=priority,
+                                     coalesce_key=coalesce_key, deadline_millis=deadline_millis)], client_id)
+        return None if tasks is None else tasks[0]
+
+    def add_tasks(self, jobs: List[dict], client_id: str | None = None) -> List[QueueTask] | None:
+        """
+        Create and add tasks to queue with one admission decision, all of them are added or none.
+        New tasks using the same models are queued next to each other, so they run without model swaps between them.
+        :param jobs: Keyword arguments of `add_task` for each task, except client_id
+        :returns: The created or attached tasks in order of jobs, or None if the new tasks exceed the queue size limit,
+            or the last of them exceeds the projected wait limit, or they exceed the capacity of the queue
+        """
+        if client_id is None or len(client_id) == 0:
+            client_id = default_client_id
+        params_data = [self.job_store.dump_params(job.get('params')) for job in jobs]
+
+        with self.lock:
+            new_jobs = self.get_new_jobs(jobs)
+            if self.exceeds_capacity(jobs):
+                return None
+
+            if len(new_jobs) > 0:
+                lowest_priority = max([jobs[i].get('priority', TaskPriority.normal) for i in new_jobs],
+                                      key=lambda p: task_priority_rank[p])
+                if self.queue_max_wait is None:
+                    if self.get_job_count() + len(new_jobs) > self.queue_size:
+                        return None
+                elif self.get_projected_wait(lowest_priority) + self.get_batch_wait(jobs, new_jobs) > self.queue_max_wait:
+                    # The last new task waits behind the queued tasks and the other new tasks
+                    return None
+
+            # Group by models, in order of first appearance
+            signature_order = {}
+            for index in range(len(jobs)):
+                signature_order.setdefault(get_model_signature(jobs[index].get('params')), len(signature_order))
+            order = sorted(range(len(jobs)), key=lambda i: signature_order[get_model_signature(jobs[i].get('params'))])
+
+            in_queue_millis = int(round(time.time() * 1000))
+            tasks: List[QueueTask | None] = [None] * len(jobs)
+            for index in order:
+                job = jobs[index]
+                coalesce_key = job.get('coalesce_key')
+                coalesce_task = self.get_coalesce_task(coalesce_key)
+                if coalesce_task is not None:
+                    tasks[index] = self.attach_task(coalesce_task, job)
+                    continue
+
+                task = QueueTask(job_id=str(uuid.uuid4()), type=job['type'], req_param=job['req_param'],
+                                 in_queue_millis=in_queue_millis, params=job.get('params'),
+                                 priority=job.get('priority', TaskPriority.normal), client_id=client_id,
+                                 deadline_millis=job.get('deadline_millis'))
+                task.coalesce_key = coalesce_key
+                self.submit_task(task)
+                self.job_store.save_task(task, params_data[index])
+                tasks[index] = task
+            return tasks
+
+    def get_new_jobs(self, jobs: List[dict]) -> List[int]:
+        """
+        Indexes of the jobs which create new tasks, the others attach to an identical task
+        """
+        with self.lock:
+            new_jobs = []
+            new_keys = set()
+            for index, job in enumerate(jobs):
+                coalesce_key = job.get('coalesce_key')
+                if coalesce_key is None or (self.get_coalesce_task(coalesce_key) is None and coalesce_key not in new_keys):
+                    new_jobs.append(index)
+                    new_keys.add(coalesce_key)
+            return new_jobs
+
+    def exceeds_capacity(self, jobs: List[dict]) -> bool:
+        """
+        Whether the new tasks of the jobs could not be added even to an empty queue, retrying them never succeeds.
+        That is more new tasks than the queue size limit, or with the projected wait limit, the last new task would
+        wait longer than the limit behind the tasks of the same jobs.
         """
-        if len(self.queue) >= self.queue_size:
+        with self.lock:
+            new_jobs = self.get_new_jobs(jobs)
+            if self.queue_max_wait is None:
+                return len(new_jobs) > self.queue_size
+            return self.get_batch_wait(jobs, new_jobs) > self.queue_max_wait
+
+    def get_batch_wait(self, jobs: List[dict], new_jobs: List[int]) -> float:
+        """
+        Seconds the last new task of the jobs waits behind the other new tasks, shared by the workers
+        """
+        with self.lock:
+            batch_cost = sum(self.throughput.estimate_job_cost(jobs[i].get('params')) for i in new_jobs[:-1])
+            online_workers = len([w for w in self.workers if w.online])
+            return batch_cost / max(online_workers, 1)
+
+    def get_coalesce_task(self, coalesce_key: str | None) -> QueueTask | None:
+        """
+        The unfinished task an identical request can attach to, a cancelled task is replaced by a new one
+        """
+        if coalesce_key is None:
+            return None
+        task = self.coalesce_index.get(coalesce_key)
+        if task is None or task.cancel_requested:
             return None
+        return task
 
-        job_id = str(uuid.uuid4())
-        task = QueueTask(job_id=job_id, type=type, req_param=req_param,
-                         in_queue_millis=int(round(time.time() * 1000)))
-        self.queue.append(task)
-        self.last_job_id = job_id
+    def attach_task(self, task: QueueTask, job: dict) -> QueueTask:
+        """
+        Attach an identical request to the waiting or running task, the task gets the highest priority of its requests
+        """
+        if job['req_param'].get('require_base64', False):
+            task.req_param['require_base64'] = True
+        priority = job.get('priority', TaskPriority.normal)
+        if task_priority_rank[priority] < task_priority_rank[task.priority]:
+            self.raise_priority(task, priority)
+        # Keep the task for the longest waiting request
+        deadline_millis = job.get('deadline_millis')
+        for t in [task] + task.sub_tasks:
+            if t.deadline_millis is not None:
+                t.deadline_millis = None if deadline_millis is None else max(t.deadline_millis, deadline_millis)
+        self.coalesced_requests += 1
+        print(f"[Task Queue] Attach identical request to job_id={task.job_id}")
+        return task
+
+    def raise_priority(self, task: QueueTask, priority: TaskPriority):
+        """
+        Move the task, or the waiting sub-tasks of a split task, to a higher priority class
+        """
+        task.priority = priority
+        for t in task.sub_tasks if len(task.sub_tasks) > 0 else [task]:
+            if t.start_millis > 0 or t.is_finished:
+                continue
+            t.priority = priority
+            self.assign_fair_tags(t)
+        self.queue_version += 1
+        self.job_store.save_task(task)
+        print(f"[Task Queue] Raise priority to {priority.value}, job_id={task.job_id}")
+        self.task_added.notify_all()
+        if not any(w.is_idle() for w in self.workers):
+            self.preempt_tasks()
+
+    def get_job_count(self) -> int:
+        """
+        Waiting and running jobs, a split job counts once
+        """
+        with self.lock:
+            return len([t for t in self.queue.values() if t.parent is None]) + len(self.parent_tasks)
+
+    def split_params(self, params: ImageGenerationParams | None) -> List[ImageGenerationParams] | None:
+        """
+        Split the params of a large batch into consecutive seed ranges of `batch_split_size` images
+        :returns: Params of each part, or None if the job is not split
+        """
+        if self.batch_split_size <= 0 or params is None or params.image_number <= self.batch_split_size:
+            return None
+        if get_job_resolution(params)[2] == 'fast_upscale':
+            # Returns one image whatever image_number is
+            return None
+
+        # The same seeds as `process_generate` uses for the whole batch
+        seed = params.image_seed
+        if seed is None or seed == -1:
+            seed = random.randint(0, max_seed)
+        sub_params = []
+        for offset in range(0, params.image_number, self.batch_split_size):
+            p = copy.copy(params)
+            p.image_number = min(self.batch_split_size, params.image_number - offset)
+            p.image_seed = (seed + offset) % (max_seed + 1)
+            sub_params.append(p)
+        return sub_params
+
+    def submit_task(self, task: QueueTask):
+        """
+        Enqueue the task, or its sub-tasks if it's a large batch
+        """
+        sub_params = self.split_params(task.params)
+        if sub_params is None:
+            self.enqueue_task(task)
+            return
+
+        with self.lock:
+            task.estimated_cost = self.throughput.estimate_job_cost(task.params)
+            for index, params in enumerate(sub_params):
+                sub_task = QueueTask(job_id=f"{task.job_id}-{index}", type=task.type, req_param=task.req_param,
+                                     in_queue_millis=task.in_queue_millis, params=params,
+                                     priority=task.priority, client_id=task.client_id, deadline_millis=task.deadline_millis)
+                sub_task.parent = task
+                task.sub_tasks.append(sub_task)
+                self.enqueue_task(sub_task)
+            if task.coalesce_key is not None:
+                self.coalesce_index[task.coalesce_key] = task
+            self.parent_tasks[task.job_id] = task
+            self.last_job_id = task.job_id
+            print(f"[Task Queue] Split task into {len(sub_params)} parts, job_id={task.job_id}")
+
+    def get_projected_wait(self, priority: TaskPriority = TaskPriority.normal) -> float:
+        """
+        Seconds a new task of the priority would wait before start, queued GPU-seconds ahead of it shared by the workers
+        """
+        with self.lock:
+            queued_cost = sum(task.remaining_cost() for task in self.queue.values()
+                              if task.start_millis > 0 or task_priority_rank[task.priority] <= task_priority_rank[priority])
+            online_workers = len([w for w in self.workers if w.online])
+            return queued_cost / max(online_workers, 1)
+
+    def update_estimated_times(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Estimate start and finish time in milliseconds of each waiting and running task, waiting tasks are
+        assigned to the worker which gets free first in scheduling order.
+        The estimates are also kept in `QueueTask.estimated_start_millis` and `QueueTask.estimated_finish_millis`,
+        they are reused until the queue changes or they are older than `estimated_times_max_age_millis`.
+        """
+        with self.lock:
+            now_millis = int(round(time.time() * 1000))
+            if self.estimated_times_version == self.queue_version \
+                    and now_millis - self.estimated_times_millis < self.estimated_times_max_age_millis:
+                return self.estimated_times
+            worker_free_millis = [now_millis] * max(len([w for w in self.workers if w.online]), 1)
+            estimated_times = {}
+            for task in self.queue.values():
+                if task.start_millis > 0:
+                    finish_millis = now_millis + int(task.remaining_cost() * 1000)
+                    estimated_times[task.job_id] = (task.start_millis, finish_millis)
+                    # Running tasks occupy the workers first
+                    index = worker_free_millis.index(min(worker_free_millis))
+                    worker_free_millis[index] = max(worker_free_millis[index], finish_millis)
+            for task in self.get_waiting_tasks():
+                index = worker_free_millis.index(min(worker_free_millis))
+                start_millis = worker_free_millis[index]
+                finish_millis = start_millis + int(task.estimated_cost * 1000)
+                estimated_times[task.job_id] = (start_millis, finish_millis)
+                worker_free_millis[index] = finish_millis
+            for job_id, (start_millis, finish_millis) in estimated_times.items():
+                task = self.queue[job_id]
+                task.estimated_start_millis = start_millis
+                task.estimated_finish_millis = finish_millis
+            for task in self.parent_tasks.values():
+                sub_times = [estimated_times[t.job_id] for t in task.sub_tasks if t.job_id in estimated_times]
+                if len(sub_times) == 0:
+                    # The remaining sub-tasks are past their deadline and about to expire
+                    continue
+                task.estimated_start_millis = task.start_millis if task.start_millis > 0 else min(t[0] for t in sub_times)
+                task.estimated_finish_millis = max(t[1] for t in sub_times)
+            self.estimated_times = estimated_times
+            self.estimated_times_version = self.queue_version
+            self.estimated_times_millis = now_millis
+            return estimated_times
+
+    def get_retry_after(self, priority: TaskPriority = TaskPriority.normal) -> int:
+        """
+        Seconds until a rejected task of the priority could be accepted
+        """
+        with self.lock:
+            if self.queue_max_wait is not None:
+                seconds = self.get_projected_wait(priority) - self.queue_max_wait
+            else:
+                now_millis = time.time() * 1000
+                seconds = min([(finish_millis - now_millis) / 1000 for _, finish_millis in self.update_estimated_times().values()],
+                              default=0)
+            return max(int(math.ceil(seconds)), 1)
+
+    def enqueue_task(self, task: QueueTask):
+        with self.lock:
+            task.estimated_cost = self.throughput.estimate_job_cost(task.params)
+            self.assign_fair_tags(task)
+
+            if task.coalesce_key is not None:
+                self.coalesce_index[task.coalesce_key] = task
+
+            self.queue[task.job_id] = task
+            self.last_job_id = task.job_id
+            self.queue_version += 1
+            if task.deadline_millis is not None:
+                self.start_deadline_sweeper()
+            self.task_added.notify_all()
+            if not any(w.is_idle() for w in self.workers):
+                self.preempt_tasks()
+
+    def assign_fair_tags(self, task: QueueTask):
+        """
+        Virtual start and finish tags of the task in its client's share of its priority class
+        """
+        fair_key = (task.priority, task.client_id)
+        task.fair_start_tag = max(self.virtual_time.get(task.priority, 0.0), self.client_finish_tags.get(fair_key, 0.0))
+        task.fair_finish_tag = task.fair_start_tag + task.fair_share_cost() / self.client_weights.get(task.client_id, 1.0)
+        self.client_finish_tags[fair_key] = task.fair_finish_tag
+
+    def set_job_store(self, job_store: JobStore):
+        """
+        Use the job store for persistence, and recover the history and unfinished tasks from it
+        """
+        with self.lock:
+            self.job_store = job_store
+            for record in job_store.load_finished_tasks(self.history_size):
+                task = self.record_to_task(record)
+                task.start_millis = record['start_millis']
+                task.finish_millis = record['finish_millis']
+                task.is_finished = True
+                task.set_result(record_to_results(record), record['status'] == job_status_error, record['error_message'])
+                task.finish_progress = record['finish_progress']
+                task.task_status = record['task_status']
+                task.future.set_result(task.task_result or [])
+                self.history.append(task)
+                self.history_index[task.job_id] = task
+
+            recovered = 0
+            for record in job_store.load_unfinished_tasks():
+                if record['params'] is None:
+                    continue
+                # Running tasks are interrupted by the restart, start them over
+                self.submit_task(self.record_to_task(record))
+                recovered += 1
+            print(f"[Task Queue] Recovered {len(self.history)} finished tasks and {recovered} unfinished tasks from job store")
+
+    @staticmethod
+    def record_to_task(record: dict) -> QueueTask:
+        params = record['params']
+        req_param = json.loads(record['req_param'])
+        if params is not None:
+            req_param['params'] = params.__dict__
+        task = QueueTask(job_id=record['job_id'], type=TaskType(record['job_type']), req_param=req_param,
+                         in_queue_millis=record['in_queue_millis'], params=params,
+                         priority=TaskPriority(record['priority']), client_id=record['client_id'],
+                         deadline_millis=record.get('deadline_millis'))
+        task.coalesce_key = record.get('coalesce_key')
         return task
 
     def get_task(self, job_id: str, include_history: bool = False) -> QueueTask | None:
-        for task in self.queue:
-            if task.job_id == job_id:
+        task = self.queue.get(job_id)
+        if task is None:
+            task = self.parent_tasks.get(job_id)
+        if task is None and include_history:
+            task = self.history_index.get(job_id)
+        return task
+
+    def get_waiting_tasks(self) -> List[QueueTask]:
+        """
+        Waiting tasks in scheduling order, strict priority between priority classes and
+        weighted fair queuing between clients in the same class
+        """
+        return sorted([task for task in self.queue.values()
+                       if task.start_millis == 0 and not task.cancel_requested and not task.is_deadline_passed()],
+                      key=lambda t: (task_priority_rank[t.priority], t.fair_finish_tag, t.sequence))
+
+    def select_next_task(self, loaded_model_signature: Tuple | None = None,
+                         waiting_tasks: List[QueueTask] | None = None) -> QueueTask | None:
+        """
+        The head of waiting tasks. A task of the same class using the loaded models can go first, unless a task
+        ahead of it was already bypassed `affinity_max_skips` times.
+        """
+        if waiting_tasks is None:
+            waiting_tasks = self.get_waiting_tasks()
+        if len(waiting_tasks) == 0:
+            return None
+
+        head = waiting_tasks[0]
+        if self.affinity_max_skips <= 0 or loaded_model_signature is None \
+                or head.model_signature == loaded_model_signature:
+            return head
+
+        for task in waiting_tasks:
+            if task.priority != head.priority:
+                break
+            if task.model_signature == loaded_model_signature:
                 return task
+            if task.affinity_skips >= self.affinity_max_skips:
+                break
+        return head
 
-        if include_history:
-            for task in self.history:
-                if task.job_id == job_id:
+    def register_worker(self, worker: 'EngineWorker'):
+        with self.lock:
+            worker.online = True
+            self.workers.append(worker)
+            self.queue_version += 1
+            self.task_added.notify_all()
+
+    def dispatch(self):
+        """
+        Assign waiting tasks to idle workers. In 'affinity' mode, an idle worker which has the models of a task
+        loaded gets that task, otherwise the head task goes to the least loaded idle worker.
+        """
+        with self.lock:
+            while True:
+                idle_workers = sorted([w for w in self.workers if w.is_idle()],
+                                      key=lambda w: (w.busy_millis, w.worker_id))
+                if len(idle_workers) == 0:
+                    self.preempt_tasks()
+                    return
+                waiting_tasks = self.get_waiting_tasks()
+                if len(waiting_tasks) == 0:
+                    return
+
+                worker, task = idle_workers[0], waiting_tasks[0]
+                if self.dispatch_mode == 'affinity':
+                    for idle_worker in idle_workers:
+                        candidate = self.select_next_task(idle_worker.loaded_model_signature, waiting_tasks)
+                        if candidate.model_signature == idle_worker.loaded_model_signature:
+                            worker, task = idle_worker, candidate
+                            break
+                self.start_task(task.job_id, worker)
+                self.task_added.notify_all()
+
+    def preempt_tasks(self):
+        """
+        Ask running tasks of lower priority than the waiting tasks to suspend at the next image boundary,
+        one running task for each waiting task. The suspended task is queued again with its fair share
+        tags and resumes from its checkpoint.
+        """
+        if not self.preemption:
+            return
+        with self.lock:
+            running_tasks = [w.running_task for w in self.workers if w.online and w.running_task is not None]
+            # Waiting tasks at the head are already served by the requested preemptions
+            requested = len([t for t in running_tasks if t.preempt_requested])
+            for task in self.get_waiting_tasks()[requested:]:
+                candidates = [t for t in running_tasks if not t.preempt_requested and not t.cancel_requested
+                              and task_priority_rank[t.priority] > task_priority_rank[task.priority]
+                              and t.params is not None and t.params.image_number > 1]
+                if len(candidates) == 0:
+                    break
+                victim = max(candidates, key=lambda t: (task_priority_rank[t.priority], t.remaining_cost()))
+                victim.preempt_requested = True
+                victim.worker.preempt_task(victim)
+                print(f"[Task Queue] Preempt task, job_id={victim.job_id}, for job_id={task.job_id}")
+
+    def wait_next_task(self, worker: 'EngineWorker', timeout: float | None = None) -> QueueTask | None:
+        """
+        Block until a task is dispatched to the worker, the task is already marked as started
+        :returns: The started task, or None on timeout
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        while True:
+            self.expire_tasks()
+            with self.task_added:
+                self.dispatch()
+                task = worker.pending_task
+                if task is not None:
+                    worker.pending_task = None
                     return task
 
-        return None
+                # Wake up for the next deadline of waiting tasks
+                wait_seconds = min([(t.deadline_millis - time.time() * 1000) / 1000 for t in self.get_waiting_tasks()
+                                    if t.deadline_millis is not None], default=None)
+                if end_time is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait_seconds = remaining if wait_seconds is None else min(wait_seconds, remaining)
+                self.task_added.wait(None if wait_seconds is None else max(wait_seconds, 0.0))
 
-    def is_task_ready_to_start(self, job_id: str) -> bool:
-        task = self.get_task(job_id)
-        if task is None:
-            return False
+    def expire_tasks(self):
+        """
+        Finish waiting tasks whose deadline passed, they never reach a worker
+        """
+        with self.lock:
+            expired_tasks = [task for task in self.queue.values()
+                             if task.start_millis == 0 and not task.cancel_requested and task.is_deadline_passed()]
+            for task in expired_tasks:
+                print(f"[Task Queue] Drop task after deadline, job_id={task.job_id}")
+                task.set_result((task.task_result or []) + [
+                    ImageGenerationResult(im=None, seed='-1', finish_reason=GenerationFinishReason.deadline_exceeded)],
+                    True, 'Deadline exceeded')
+                # Finished under the lock, so a concurrent expire or cancel doesn't finish it again
+                self.finish_task(task.job_id)
+                task.future.set_result(task.task_result)
 
-        return self.queue[0].job_id == job_id
+    def start_deadline_sweeper(self):
+        with self.lock:
+            if self.deadline_sweeper is not None:
+                return
+            self.deadline_sweeper = threading.Thread(target=self.sweep_deadlines, name="deadline_sweeper", daemon=True)
+            self.deadline_sweeper.start()
 
-    def start_task(self, job_id: str):
-        task = self.get_task(job_id)
-        if task is not None:
+    def sweep_deadlines(self):
+        """
+        Expire waiting tasks at their deadline, workers only expire tasks when they look for the next one
+        """
+        while True:
+            try:
+                self.expire_tasks()
+            except Exception as e:
+                print('[Task Queue] Expire tasks error:', e)
+                time.sleep(1)
+            with self.task_added:
+                now_millis = time.time() * 1000
+                wait_seconds = min([(t.deadline_millis - now_millis) / 1000 for t in self.queue.values()
+                                    if t.start_millis == 0 and not t.cancel_requested and t.deadline_millis is not None],
+                                   default=None)
+                self.task_added.wait(None if wait_seconds is None else max(wait_seconds, 0.0))
+
+    def start_task(self, job_id: str, worker: 'EngineWorker | None' = None):
+        with self.lock:
+            task = self.get_task(job_id)
+            if task is None:
+                return
             task.start_millis = int(round(time.time() * 1000))
+            self.queue_version += 1
+
+            # Count the tasks bypassed by this one for the loaded models
+            bypassed = False
+            for waiting_task in self.queue.values():
+                if waiting_task.start_millis == 0 and waiting_task.priority == task.priority \
+                        and (waiting_task.fair_finish_tag, waiting_task.sequence) < (task.fair_finish_tag, task.sequence):
+                    waiting_task.affinity_skips += 1
+                    bypassed = True
+
+            if worker is not None:
+                task.worker = worker
+                worker.running_task = task
+                worker.pending_task = task
+                if task.model_signature is not None:
+                    if bypassed and task.model_signature == worker.loaded_model_signature:
+                        self.model_swaps_avoided += 1
+                    elif worker.loaded_model_signature is not None and task.model_signature != worker.loaded_model_signature:
+                        self.model_swaps += 1
+                    worker.loaded_model_signature = task.model_signature
+
+            # Advance the virtual clock and forget clients which are not ahead of it
+            virtual_time = max(self.virtual_time.get(task.priority, 0.0), task.fair_start_tag)
+            self.virtual_time[task.priority] = virtual_time
+            for key in [k for k, v in self.client_finish_tags.items() if k[0] == task.priority and v <= virtual_time]:
+                del self.client_finish_tags[key]
+
+            task.events.publish(ProgressStage.running, task.finish_progress, task.task_status)
+            if task.parent is not None:
+                # Only the split task is persisted
+                if task.parent.start_millis == 0:
+                    task.parent.start_millis = task.start_millis
+                    task.parent.events.publish(ProgressStage.running, task.parent.finish_progress, task.parent.task_status)
+                    self.job_store.save_task(task.parent)
+            else:
+                self.job_store.save_task(task)
+
+    def cancel_task(self, job_id: str) -> QueueTask | None:
+        """
+        Cancel a task, a waiting task is removed from queue at once, a running task stops at the next sampling step
+        and keeps the images already finished
+        :returns: The task, or None if not found
+        """
+        with self.lock:
+            task = self.get_task(job_id, include_history=True)
+            if task is None or task.is_finished:
+                return task
+            task.cancel_requested = True
+            if len(task.sub_tasks) > 0:
+                for sub_task in task.sub_tasks:
+                    if not sub_task.is_finished:
+                        self.cancel_task(sub_task.job_id)
+                return task
+            if task.start_millis > 0:
+                if task.worker is not None:
+                    task.worker.cancel_task(task)
+                print(f"[Task Queue] Cancel running task, job_id={job_id}")
+                return task
+
+            print(f"[Task Queue] Cancel waiting task, job_id={job_id}")
+            # A suspended task keeps the images finished before preemption
+            task.set_result((task.task_result or []) + [
+                ImageGenerationResult(im=None, seed='-1', finish_reason=GenerationFinishReason.user_cancel)],
+                True, 'Job cancelled')
+            self.finish_task(job_id)
+            task.future.set_result(task.task_result)
+        return task
+
+    def record_timings(self, task: QueueTask):
+        if task.timings is None:
+            return
+        self.throughput.record(task.timings)
+        self.queue_version += 1
+        if task.timings.get('checkpoint_seconds') is not None:
+            self.preempt_overhead_seconds += task.timings['checkpoint_seconds']
+        if task.timings.get('resumed') and task.timings.get('prepare_seconds') is not None:
+            self.preempt_overhead_seconds += task.timings['prepare_seconds']
+        # A suspended task reports the timings of its next run again
+        task.timings = None
+
+    def release_worker(self, task: QueueTask, end_millis: int):
+        task.worker.running_task = None
+        task.worker.busy_millis += end_millis - task.start_millis
+        # The worker is free for the next task
+        self.task_added.notify_all()
+
+    def suspend_task(self, job_id: str):
+        """
+        Queue a preempted task again, it keeps its place in the fair share order and resumes from its checkpoint.
+        A task cancelled while it was suspending is finished instead.
+        """
+        with self.lock:
+            task = self.queue.get(job_id)
+            if task is None:
+                return
+            if task.cancel_requested:
+                print(f"[Task Queue] Cancel suspended task, job_id={job_id}")
+                task.checkpoint = None
+                task.set_result((task.task_result or []) + [
+                    ImageGenerationResult(im=None, seed='-1', finish_reason=GenerationFinishReason.user_cancel)],
+                    True, 'Job cancelled')
+                self.finish_task(job_id)
+                task.future.set_result(task.task_result)
+                return
+            self.record_timings(task)
+            if task.worker is not None:
+                self.release_worker(task, int(round(time.time() * 1000)))
+                task.worker = None
+            task.start_millis = 0
+            task.preempt_requested = False
+            self.queue_version += 1
+            image_number = max(task.params.image_number, 1)
+            # The checkpoint counts images from the start of the job, not from the last resume
+            task.estimated_cost = self.throughput.estimate_job_cost(task.params) * \
+                (image_number - task.checkpoint['next_index']) / image_number
+            self.preempted_jobs += 1
+            task.events.publish(ProgressStage.suspended, task.finish_progress, 'Suspended')
+            self.task_added.notify_all()
 
     def finish_task(self, job_id: str):
-        task = self.get_task(job_id)
-        if task is not None:
+        with self.lock:
+            task = self.queue.pop(job_id, None)
+            if task is None:
+                return
             task.is_finished = True
             task.finish_millis = int(round(time.time() * 1000))
+            self.queue_version += 1
+            timings = task.timings
+            self.record_timings(task)
+            task.publish_finished(timings)
+            if is_deadline_exceeded(task):
+                # A split task is counted as one job when its last sub-task finishes
+                if task.parent is None:
+                    self.deadline_expired_jobs += 1
+                self.deadline_saved_seconds += task.estimated_cost * (100 - task.finish_progress) / 100
+            if task.worker is not None:
+                self.release_worker(task, task.finish_millis)
+                task.worker.completed_tasks += 1
 
-            # Send webhook
-            if task.is_finished and self.webhook_url:
-                data = { "job_id": task.job_id, "job_result": [] }
-                if isinstance(task.task_result, List):
-                    for item in task.task_result:
-                        data["job_result"].append({
-                            "url": get_file_serve_url(item.im) if item.im else None,
-                            "seed": item.seed if item.seed else "-1",
-                        })
-                try:
-                    res = requests.post(self.webhook_url, json=data)
-                    print(f'Call webhook response status: {res.status_code}')
-                except Exception as e:
-                    print('Call webhook error:', e)
+            if task.parent is not None:
+                # The split task is finished with its last sub-task
+                if not task.parent.update_from_sub_tasks():
+                    return
+                task = task.parent
+                job_id = task.job_id
+                del self.parent_tasks[job_id]
+                task.is_finished = True
+                task.finish_millis = int(round(time.time() * 1000))
+                task.publish_finished()
+                task.future.set_result(task.task_result)
+                if is_deadline_exceeded(task):
+                    self.deadline_expired_jobs += 1
+
+            if task.coalesce_key is not None and self.coalesce_index.get(task.coalesce_key) is task:
+                # A cancelled task may be replaced by a new one already
+                del self.coalesce_index[task.coalesce_key]
 
             # Move task to history
-            self.queue.remove(task)
             self.history.append(task)
+            self.history_index[job_id] = task
 
             # Clean history
-            if len(self.history) > self.history_size:
-                removed_task = self.history.pop(0)
-                if isinstance(removed_task.task_result, List):
-                    for item in removed_task.task_result:
-                        if isinstance(item, ImageGenerationResult) and item.finish_reason == GenerationFinishReason.success and item.im is not None:
-                            delete_output_file(item.im)
-                print(f"Clean task history, remove task: {removed_task.job_id}")
+            removed_tasks: List[QueueTask] = []
+            while len(self.history) > self.history_size:
+                removed_task = self.history.popleft()
+                self.history_index.pop(removed_task.job_id, None)
+                removed_tasks.append(removed_task)
+
+            self.job_store.save_task(task)
+            self.job_store.delete_tasks([t.job_id for t in removed_tasks])
+
+        # Send webhook
+        if self.webhook_url:
+            data = { "job_id": task.job_id, "job_result": [] }
+            if isinstance(task.task_result, List):
+                for item in task.task_result:
+                    data["job_result"].append({
+                        "url": get_file_serve_url(item.im) if item.im else None,
+                        "seed": item.seed if item.seed else "-1",
+                    })
+            if self.webhook_dispatcher is None or self.webhook_dispatcher.url != self.webhook_url:
+                self.webhook_dispatcher = WebhookDispatcher(self.webhook_url)
+            self.webhook_dispatcher.send(data)
+
+        removed_files = []
+        for removed_task in removed_tasks:
+            if isinstance(removed_task.task_result, List):
+                for item in removed_task.task_result:
+                    if isinstance(item, ImageGenerationResult) and item.finish_reason == GenerationFinishReason.success and item.im is not None:
+                        removed_files.append(item.im)
+            print(f"Clean task history, remove task: {removed_task.job_id}")
+        self.output_janitor.delete_files(removed_files)
 
 
 class TaskOutputs:
-    outputs = []
+    """
+    Receives the yields of the generation like Fooocus's async task, progress goes to the task's events
+    """
 
     def __init__(self, task: QueueTask):
         self.task = task
 
     def append(self, args: List[any]):
-        self.outputs.append(args)
         if len(args) >= 2:
             if args[0] == 'preview' and isinstance(args[1], Tuple) and len(args[1]) >= 2:
                 number = args[1][0]
                 text = args[1][1]
-                self.task.set_progress(number, text)
-                if len(args[1]) >= 3 and isinstance(args[1][2], np.ndarray):
-                    base64_preview_img = narray_to_base64img(args[1][2])
-                    self.task.set_step_preview(base64_preview_img)
\ No newline at end of file
+                image = args[1][2] if len(args[1]) >= 3 and isinstance(args[1][2], np.ndarray) else None
+                # Sampling steps add (step, total_steps)
+                step, total_steps = args[1][3:5] if len(args[1]) >= 5 else (None, None)
+                self.task.set_progress(number, text, step, total_steps, image)
\ No newline at end of file
@@ -0,0 +1,160 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from typing import List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class WebhookDispatcher(object):
+    """
+    Delivers job notifications to the webhook url from a background thread, with a keep-alive connection,
+    timeouts and exponential backoff retries.
+    If `spool_dir` is set, each notification is written there by another background thread until delivered,
+    and the spool is sent again after restart. With `batch_size` > 1, queued notifications are posted together
+    as {"jobs": [...]}.
+    """
+
+    def __init__(self, url: str, spool_dir: str | None = None, batch_size: int = 1, timeout: float = 10,
+                 max_retries: int = 8, backoff_seconds: float = 1.0, max_backoff_seconds: float = 300):
+        self.url = url
+        self.spool_dir = spool_dir
+        self.batch_size = max(batch_size, 1)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        # Items are (spool filename or None, notification)
+        self.send_queue: queue.Queue = queue.Queue()
+        # Notifications to write to the spool before they are sent
+        self.spool_queue: queue.Queue = queue.Queue()
+        self.delivered = 0
+        self.failed = 0
+        self.thread: threading.Thread | None = None
+        self.spool_thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+        if self.spool_dir is not None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self.load_spool()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="webhook_dispatcher", daemon=True)
+            self.thread.start()
+            if self.spool_dir is not None:
+                self.spool_thread = threading.Thread(target=self.spool_loop, name="webhook_spool", daemon=True)
+                self.spool_thread.start()
+
+    def load_spool(self):
+        filenames = sorted(f for f in os.listdir(self.spool_dir) if f.endswith('.json'))
+        for filename in filenames:
+            try:
+                with open(os.path.join(self.spool_dir, filename), 'r', encoding='utf-8') as f:
+                    self.send_queue.put((filename, json.load(f)))
+            except Exception as e:
+                print(f"[Webhook] Drop unreadable spool file {filename}:", e)
+                self.remove_spool_files([filename])
+        if len(filenames) > 0:
+            print(f"[Webhook] Loaded {len(filenames)} undelivered notifications from spool")
+            self.start()
+
+    def send(self, data: dict):
+        """
+        Queue a notification, returns at once without touching the filesystem
+        """
+        self.start()
+        if self.spool_dir is not None:
+            self.spool_queue.put(data)
+        else:
+            self.send_queue.put((None, data))
+
+    def spool_loop(self):
+        while True:
+            data = self.spool_queue.get()
+            self.send_queue.put((self.write_spool(data), data))
+
+    def write_spool(self, data: dict) -> str | None:
+        """
+        :returns: The spool filename, or None if it can't be written
+        """
+        # Names sort in submit order
+        filename = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+        tmp_path = os.path.join(self.spool_dir, filename + '.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, os.path.join(self.spool_dir, filename))
+        except Exception as e:
+            print('[Webhook] Write spool error:', e)
+            return None
+        return filename
+
+    def remove_spool_files(self, filenames: List[str | None]):
+        for filename in filenames:
+            if filename is None:
+                continue
+            try:
+                os.remove(os.path.join(self.spool_dir, filename))
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            batch: List[Tuple[str | None, dict]] = [self.send_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.send_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if self.batch_size > 1:
+                payload = {"jobs": [data for _, data in batch]}
+            else:
+                payload = batch[0][1]
+            if self.deliver(payload):
+                self.delivered += len(batch)
+            else:
+                self.failed += len(batch)
+            self.remove_spool_files([filename for filename, _ in batch])
+
+    def deliver(self, payload: dict) -> bool:
+        """
+        POST the payload, retrying connection errors, timeouts, 408, 429 and 5xx responses
+        :returns: True if delivered
+        """
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                res = self.session.post(self.url, json=payload, timeout=self.timeout)
+                if res.status_code < 300:
+                    print(f'Call webhook response status: {res.status_code}')
+                    return True
+                if res.status_code < 500 and res.status_code not in (408, 429):
+                    print(f'[Webhook] Rejected with status {res.status_code}, drop notification')
+                    return False
+                print(f'[Webhook] Response status {res.status_code}, attempt {attempt + 1}')
+                if res.headers.get('Retry-After', '').isdigit():
+                    retry_after = float(res.headers['Retry-After'])
+            except requests.RequestException as e:
+                print(f'Call webhook error, attempt {attempt + 1}:', e)
+
+            if attempt < self.max_retries:
+                backoff = min(self.backoff_seconds * 2 ** attempt, self.max_backoff_seconds)
+                # Full jitter, so restarted receivers are not hit by all retries at once
+                delay = random.uniform(0, backoff) if retry_after is None else min(retry_after, self.max_backoff_seconds)
+                time.sleep(delay)
+        print(f'[Webhook] Give up after {self.max_retries + 1} attempts')
+        return False
@@ -4,18 +4,61 @@ import time
 import numpy as np
 import torch
 import re
+import threading
 from typing import List
+from fooocusapi.checkpoint_store import CheckpointStore
 from fooocusapi.file_utils import save_output_file
 from fooocusapi.parameters import GenerationFinishReason, ImageGenerationParams, ImageGenerationResult
+from fooocusapi.engine import EngineWorker, start_engine_workers
 from fooocusapi.task_queue import QueueTask, TaskQueue, TaskOutputs
 
 
 task_queue = TaskQueue(queue_size=3, hisotry_size=6, webhook_url=None)
+task_engine_threads: List[threading.Thread] = []
+
+# Prepared prompts of tasks preempted in this process
+checkpoint_store = CheckpointStore()
+
+
+class InProcessEngineWorker(EngineWorker):
+    """
+    Runs tasks with the pipeline loaded in this process
+    """
+
+    def run_task(self, task: QueueTask) -> List[ImageGenerationResult]:
+        return process_generate(task, task.params)
+
+    def interrupt(self):
+        import ldm_patched.modules.model_management
+        ldm_patched.modules.model_management.interrupt_current_processing()
+
+
+def start_task_engine(device_ids: List[str] | None = None, in_process: bool = True, argv: List[str] | None = None):
+    global task_engine_threads
+    if len(task_engine_threads) > 0:
+        return
+    if in_process:
+        if device_ids is not None and len(device_ids) > 1:
+            # Fooocus pipeline is a module level singleton, only one device can be served in one process
+            print(f"[Task Queue] In process engine can only use one device, using device {device_ids[0]}")
+        device_id = None if device_ids is None or len(device_ids) == 0 else device_ids[0]
+        workers = [InProcessEngineWorker(0, device_id)]
+    else:
+        import atexit
+        from fooocusapi.engine_process import ProcessEngineWorker
+        if device_ids is None or len(device_ids) == 0:
+            device_ids = [None]
+        workers = [ProcessEngineWorker(i, device_id, argv) for i, device_id in enumerate(device_ids)]
+        for w in workers:
+            w.start_process()
+            atexit.register(w.stop_process)
+    task_engine_threads = start_engine_workers(task_queue, workers)
 
 
 def process_top():
-    import ldm_patched.modules.model_management
-    ldm_patched.modules.model_management.interrupt_current_processing()
+    for w in task_queue.workers:
+        if w.running_task is not None:
+            w.interrupt()
 
 
 @torch.no_grad()
@@ -26,9 +69,7 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
     except Exception as e:
         print('Import default pipeline error:', e)
         if not async_task.is_finished:
-            task_queue.finish_task(async_task.job_id)
             async_task.set_result([], True, str(e))
-            print(f"[Task Queue] Finish task with error, seq={async_task.job_id}")
         return []
 
     import modules.patch as patch
@@ -52,6 +93,11 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
     outputs = TaskOutputs(async_task)
     results = []
 
+    # Measured for the queue's throughput estimator
+    process_start_time = time.perf_counter()
+    timings = {'prepare_seconds': None, 'steps': 0, 'sampling_seconds': 0.0, 'images': 0, 'image_seconds': 0.0}
+    step_timer = {'last': None}
+
     def refresh_seed(r, seed_string):
         if r:
             return random.randint(constants.MIN_SEED, constants.MAX_SEED)
@@ -68,42 +114,29 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
         print(f'[Fooocus] {text}')
         outputs.append(['preview', (number, text, None)])
 
+    def save_result(im, seed) -> ImageGenerationResult:
+        img_filename = save_output_file(im)
+        return ImageGenerationResult(im=img_filename, seed=str(seed), finish_reason=GenerationFinishReason.success)
+
     def yield_result(_, imgs, tasks):
         if not isinstance(imgs, list):
             imgs = [imgs]
 
         results = []
         for i, im in enumerate(imgs):
+            if isinstance(im, ImageGenerationResult):
+                # Already saved when the image was finished
+                results.append(im)
+                continue
             seed = -1 if len(tasks) == 0 else tasks[i]['task_seed']
-            img_filename = save_output_file(im)
-            results.append(ImageGenerationResult(im=img_filename, seed=str(seed), finish_reason=GenerationFinishReason.success))
+            results.append(save_result(im, seed))
         async_task.set_result(results, False)
-        task_queue.finish_task(async_task.job_id)
-        print(f"[Task Queue] Finish task, job_id={async_task.job_id}")
 
         outputs.append(['results', imgs])
         pipeline.prepare_text_encoder(async_call=True)
         return results
 
     try:
-        waiting_sleep_steps: int = 0
-        waiting_start_time = time.perf_counter()
-        while not task_queue.is_task_ready_to_start(async_task.job_id):
-            if waiting_sleep_steps == 0:
-                print(
-                    f"[Task Queue] Waiting for task queue become free, job_id={async_task.job_id}")
-            delay = 0.1
-            time.sleep(delay)
-            waiting_sleep_steps += 1
-            if waiting_sleep_steps % int(10 / delay) == 0:
-                waiting_time = time.perf_counter() - waiting_start_time
-                print(
-                    f"[Task Queue] Already waiting for {waiting_time}S, seq={async_task.job_id}")
-
-        print(f"[Task Queue] Task queue is free, start task, job_id={async_task.job_id}")
-
-        task_queue.start_task(async_task.job_id)
-
         execution_start_time = time.perf_counter()
 
         # Transform pamameters
@@ -146,6 +179,17 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
 
         image_seed = refresh_seed(image_seed is None, image_seed)
 
+        # A preempted task resumes with the same seeds and keeps the images finished before
+        checkpoint = async_task.checkpoint
+        async_task.checkpoint = None
+        resume_index = 0
+        if checkpoint is not None:
+            image_seed = checkpoint['seed']
+            resume_index = checkpoint['next_index']
+            results = list(checkpoint['results'])
+            timings['resumed'] = True
+            print(f'[Preemption] Resume from image #{resume_index + 1}')
+
         cn_tasks = {x: [] for x in flags.ip_list}
         for img_prompt in params.image_prompts:
             cn_img, cn_stop, cn_weight, cn_type = img_prompt
@@ -407,8 +451,16 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
                     log_negative_prompt='; '.join([task_negative_prompt] + task_extra_negative_prompts),
                 ))
 
+            # Prepared prompts kept when the task was preempted
+            prepared_tasks = checkpoint_store.take(async_task.job_id) if checkpoint is not None else None
+            if prepared_tasks is not None and len(prepared_tasks) == len(tasks) - resume_index:
+                for t, prepared in zip(tasks[resume_index:], prepared_tasks):
+                    t.update(prepared)
+
             if use_expansion:
                 for i, t in enumerate(tasks):
+                    if i < resume_index or t['c'] is not None:
+                        continue
                     progressbar(async_task, 5, f'Preparing Fooocus text #{i + 1} ...')
                     expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
                     print(f'[Prompt Expansion] {expansion}')
@@ -416,10 +468,14 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
                     t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
 
             for i, t in enumerate(tasks):
+                if i < resume_index or t['c'] is not None:
+                    continue
                 progressbar(async_task, 7, f'Encoding positive #{i + 1} ...')
                 t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'])
 
             for i, t in enumerate(tasks):
+                if i < resume_index or t['uc'] is not None:
+                    continue
                 if abs(float(cfg_scale) - 1.0) < 1e-4:
                     t['uc'] = pipeline.clone_cond(t['c'])
                 else:
@@ -732,16 +788,50 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
         outputs.append(['preview', (13, 'Moving model to GPU ...', None)])
 
         def callback(step, x0, x, total_steps, y):
+            if async_task.cancel_requested:
+                raise model_management.InterruptProcessingException()
+
+            now = time.perf_counter()
+            if timings['prepare_seconds'] is None:
+                timings['prepare_seconds'] = now - process_start_time
+            if step_timer['last'] is not None:
+                timings['steps'] += 1
+                timings['sampling_seconds'] += now - step_timer['last']
+            step_timer['last'] = now
+
             done_steps = current_task_id * steps + step
             outputs.append(['preview', (
                 int(15.0 + 85.0 * float(done_steps) / float(all_steps)),
                 f'Step {step}/{total_steps} in the {current_task_id + 1}-th Sampling',
-                y)])
+                y, step, total_steps)])
 
         for current_task_id, task in enumerate(tasks):
+            if current_task_id < resume_index:
+                continue
             execution_start_time = time.perf_counter()
+            step_timer['last'] = None
+
+            if current_task_id > resume_index and async_task.preempt_requested and not async_task.cancel_requested:
+                # Suspend at the image boundary, the sampler state inside process_diffusion can't be saved
+                checkpoint_start_time = time.perf_counter()
+                checkpoint_store.put(async_task.job_id, tasks[current_task_id:])
+                async_task.set_checkpoint(dict(seed=seed, next_index=current_task_id, results=results))
+                timings['checkpoint_seconds'] = time.perf_counter() - checkpoint_start_time
+                print(f'[Preemption] Suspend after {current_task_id} images')
+                break
+
+            if current_task_id > 0 and async_task.is_deadline_passed():
+                # Nobody waits for the rest of the batch
+                print('Deadline exceeded')
+                results.append(ImageGenerationResult(
+                    im=None, seed=task['task_seed'], finish_reason=GenerationFinishReason.deadline_exceeded))
+                async_task.set_result(results, True, 'Deadline exceeded')
+                break
 
             try:
+                if async_task.cancel_requested:
+                    raise model_management.InterruptProcessingException()
+
                 positive_cond, negative_cond = task['c'], task['uc']
 
                 if 'cn' in goals:
@@ -806,12 +896,18 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
                 
                 # Fooocus async_worker.py code end
                 
-                results += imgs
+                # Save the images now, so they are kept if the following ones are cancelled
+                results += [save_result(x, task['task_seed']) for x in imgs]
+                async_task.set_partial_result(list(results))
+                if step_timer['last'] is not None:
+                    # VAE decoding, post processing and logging
+                    timings['images'] += len(imgs)
+                    timings['image_seconds'] += time.perf_counter() - step_timer['last']
             except model_management.InterruptProcessingException as e:
                 print("User stopped")
                 results.append(ImageGenerationResult(
                     im=None, seed=task['task_seed'], finish_reason=GenerationFinishReason.user_cancel))
-                async_task.set_result(results, True, str(e))
+                async_task.set_result(results, True, 'Job cancelled' if async_task.cancel_requested else str(e))
                 break
             except Exception as e:
                 print('Process error:', e)
@@ -823,14 +919,18 @@ def process_generate(async_task: QueueTask, params: ImageGenerationParams) -> Li
             execution_time = time.perf_counter() - execution_start_time
             print(f'Generating and saving time: {execution_time:.2f} seconds')
 
+        timings.update(model=base_model_name, width=width, height=height, sampler=sampler_name,
+                       controlnets=len(cn_tasks[flags.cn_canny]) + len(cn_tasks[flags.cn_cpds]),
+                       ip_adapters=len(cn_tasks[flags.cn_ip]) + len(cn_tasks[flags.cn_ip_face]))
+        async_task.set_timings(timings)
+
+        if async_task.checkpoint is not None:
+            return results
         if async_task.finish_with_error:
-            task_queue.finish_task(async_task.job_id)
             return async_task.task_result
         return yield_result(None, results, tasks)
     except Exception as e:
         print('Worker error:', e)
         if not async_task.is_finished:
-            task_queue.finish_task(async_task.job_id)
             async_task.set_result([], True, str(e))
-            print(f"[Task Queue] Finish task with error, job_id={async_task.job_id}")
         return []
@@ -261,14 +261,42 @@ def install_dependents(args):
 
 def prepare_environments(args) -> bool:
     import fooocusapi.worker as worker
+    from fooocusapi.task_queue import parse_client_weights
     worker.task_queue.queue_size = args.queue_size
     worker.task_queue.history_size = args.queue_history
     worker.task_queue.webhook_url = args.webhook_url
-    print(f"[Fooocus-API] Task queue size: {args.queue_size}, queue history size: {args.queue_history}, webhook url: {args.webhook_url}")
-
-    if args.gpu_device_id is not None:
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu_device_id)
-        print("Set device to:", args.gpu_device_id)
+    if args.webhook_url is not None:
+        from fooocusapi.webhook import WebhookDispatcher
+        worker.task_queue.webhook_dispatcher = WebhookDispatcher(args.webhook_url, spool_dir=args.webhook_spool,
+                                                                 batch_size=args.webhook_batch_size, timeout=args.webhook_timeout)
+    worker.task_queue.queue_max_wait = args.queue_max_wait
+    worker.task_queue.affinity_max_skips = args.affinity_max_skips
+    worker.task_queue.client_weights = parse_client_weights(args.client_weights)
+    worker.task_queue.batch_split_size = args.batch_split_size
+    worker.task_queue.preemption = args.preemption
+    worker.checkpoint_store.max_bytes = int(args.checkpoint_max_memory * 1024 * 1024)
+    worker.task_queue.output_janitor.max_age_hours = args.output_max_age
+    worker.task_queue.output_janitor.max_bytes = None if args.output_max_size is None else int(args.output_max_size * 1024 ** 3)
+    worker.task_queue.output_janitor.start()
+    worker.task_queue.dispatch_mode = args.dispatch_mode
+    if args.job_store is not None:
+        import atexit
+        from fooocusapi.job_store import SqliteJobStore
+        job_store = SqliteJobStore(args.job_store)
+        atexit.register(job_store.close)
+        worker.task_queue.set_job_store(job_store)
+    print(f"[Fooocus-API] Task queue size: {args.queue_size}, queue max wait: {args.queue_max_wait}, queue history size: {args.queue_history}, webhook url: {args.webhook_url}")
+
+    device_ids = None
+    if args.gpu_device_ids is not None and len(args.gpu_device_ids.strip()) > 0:
+        device_ids = [d.strip() for d in args.gpu_device_ids.split(',') if len(d.strip()) > 0]
+    elif args.gpu_device_id is not None:
+        device_ids = [str(args.gpu_device_id)]
+    if device_ids is not None:
+        # Engine processes select their own device
+        if args.in_process_engine:
+            os.environ['CUDA_VISIBLE_DEVICES'] = device_ids[0]
+        print("Set devices to:", device_ids)
 
     if args.base_url is None or len(args.base_url.strip()) == 0:
         host = args.host
@@ -276,6 +304,8 @@ def prepare_environments(args) -> bool:
             host = '127.0.0.1'
         args.base_url = f"http://{host}:{args.port}"
 
+    # Engine processes parse the same arguments again
+    engine_argv = list(sys.argv)
     sys.argv = [sys.argv[0]]
 
     if args.preset is not None:
@@ -303,9 +333,10 @@ def prepare_environments(args) -> bool:
 
     download_models()
 
-    if args.preload_pipeline:
+    if args.preload_pipeline and args.in_process_engine:
         preplaod_pipeline()
 
+    worker.start_task_engine(device_ids, args.in_process_engine, engine_argv)
     return True
 
 def pre_setup(skip_sync_repo: bool=False, disable_private_log: bool=False, skip_pip=False, load_all_models: bool=False, preload_pipeline: bool=False, always_gpu: bool=False, all_in_fp16: bool=False, preset: str | None=None):
@@ -319,10 +350,26 @@ def pre_setup(skip_sync_repo: bool=False, disable_private_log: bool=False, skip_
         preload_pipeline = False
         queue_size = 3
         queue_history = 100
+        queue_max_wait = None
+        output_max_age = None
+        output_max_size = None
+        batch_split_size = 0
+        preemption = False
+        checkpoint_max_memory = 1024
+        affinity_max_skips = 3
+        client_weights = None
+        dispatch_mode = 'affinity'
+        job_store = None
+        gpu_device_ids = None
+        in_process_engine = True
         preset = None
         always_gpu = False
         all_in_fp16 = False
         gpu_device_id = None
+        webhook_url = None
+        webhook_spool = None
+        webhook_batch_size = 1
+        webhook_timeout = 10
 
     print("[Pre Setup] Prepare environments")
 
@@ -385,9 +432,10 @@ if __name__ == "__main__":
     if prepare_environments(args):
         sys.argv = [sys.argv[0]]
 
-        # Load pipeline in new thread
-        t = Thread(target=preplaod_pipeline, daemon=True)
-        t.start()
+        if args.in_process_engine:
+            # Load pipeline in new thread
+            t = Thread(target=preplaod_pipeline, daemon=True)
+            t.start()
 
         # Start api server
         from fooocusapi.api import start_app
@@ -8,7 +8,7 @@ from cog import BasePredictor, Input, Path
 
 from fooocusapi.parameters import GenerationFinishReason, ImageGenerationParams, available_aspect_ratios, uov_methods, outpaint_expansions, defualt_styles, default_base_model_name, default_refiner_model_name, default_loras, default_refiner_switch, default_cfg_scale, default_prompt_negative
 from fooocusapi.task_queue import TaskType
-from fooocusapi.worker import process_generate, task_queue
+from fooocusapi.worker import task_queue
 from fooocusapi.file_utils import output_dir
 import numpy as np
 from PIL import Image
@@ -172,13 +172,13 @@ class Predictor(BasePredictor):
 
         print(f"[Predictor Predict] Params: {params.__dict__}")
 
-        queue_task = task_queue.add_task(TaskType.text_2_img, {'params': params.__dict__, 'require_base64': False})
+        queue_task = task_queue.add_task(TaskType.text_2_img, {'params': params.__dict__, 'require_base64': False}, params)
         if queue_task is None:
             print("[Task Queue] The task queue has reached limit")
             raise Exception(
                 f"The task queue has reached limit."
             )
-        results = process_generate(queue_task, params)
+        results = queue_task.future.result()
 
         output_paths: List[Path] = []
         for r in results:
@@ -0,0 +1,141 @@
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+import threading
+import time
+from typing import List
+
+import numpy as np
+import pytest
+
+from fooocusapi.engine_process import ProcessEngineWorker, SharedArray, attach_arrays, preview_slot_free, preview_slot_full
+from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
+from fooocusapi.task_queue import QueueTask, TaskType
+from tests.utils import make_params
+
+
+def collect_segment_names(value: any) -> List[str]:
+    if isinstance(value, SharedArray):
+        return [value.name]
+    if isinstance(value, dict):
+        return sum([collect_segment_names(v) for v in value.values()], [])
+    if isinstance(value, (list, tuple)):
+        return sum([collect_segment_names(v) for v in value], [])
+    return []
+
+
+def dummy_engine_main(conn: Connection, device_id: str | None, argv: List[str], preview_slot_name: str):
+    """
+    Stand-in for `engine_process_main` speaking the same pipe and shared memory protocol without a pipeline.
+    The prompt selects the behaviour: 'crash' exits, 'wait' waits for a cancel or preempt message.
+    """
+    preview_slot = shared_memory.SharedMemory(name=preview_slot_name)
+    while True:
+        message = conn.recv()
+        if message[0] == 'stop':
+            break
+        if message[0] != 'run':
+            continue
+        _, job_id, type_value, params_dict, deadline_millis, checkpoint = message
+        segment_names = collect_segment_names(params_dict)
+        params = attach_arrays(params_dict)
+        if params['prompt'] == 'crash':
+            raise SystemExit(3)
+
+        image = params['uov_input_image']
+        preview = np.full((8, 8, 3), image.sum() % 256, dtype=np.uint8)
+        assert preview_slot.buf[0] == preview_slot_free
+        np.ndarray(preview.shape, dtype=preview.dtype, buffer=preview_slot.buf, offset=1)[...] = preview
+        preview_slot.buf[0] = preview_slot_full
+        conn.send(('progress', job_id, 50, 'Step 1/2', 1, 2, (preview.shape, preview.dtype.str)))
+
+        timings = {'segments': segment_names, 'sum': int(image.sum()), 'mask_sum': int(params['inpaint_input_image']['mask'].sum()),
+                   'resumed': checkpoint is not None}
+        results = [ImageGenerationResult(im='first.png', seed='1', finish_reason=GenerationFinishReason.success)]
+        conn.send(('partial', job_id, results))
+        if params['prompt'] == 'wait':
+            control = conn.recv()
+            if control[0] == 'cancel':
+                results = results + [ImageGenerationResult(im=None, seed='2', finish_reason=GenerationFinishReason.user_cancel)]
+                conn.send(('result', job_id, results, True, 'Job cancelled', timings, None))
+            elif control[0] == 'preempt':
+                conn.send(('result', job_id, results, False, None, timings, dict(seed=1, next_index=1, results=results)))
+            continue
+        conn.send(('result', job_id, results, False, None, timings, None))
+    preview_slot.close()
+
+
+def make_task(prompt: str) -> QueueTask:
+    params = make_params(image_number=2, prompt=prompt)
+    params.uov_input_image = np.arange(64 * 64 * 3, dtype=np.uint8).reshape((64, 64, 3))
+    params.inpaint_input_image = {'image': params.uov_input_image, 'mask': np.ones((64, 64), dtype=np.uint8)}
+    return QueueTask(job_id=prompt, type=TaskType.text_2_img, req_param={}, in_queue_millis=0, params=params)
+
+
+@pytest.fixture
+def worker():
+    worker = ProcessEngineWorker(0, argv=[])
+    worker.process_main = dummy_engine_main
+    yield worker
+    worker.stop_process()
+
+
+def run_in_thread(worker: ProcessEngineWorker, task: QueueTask) -> threading.Thread:
+    thread = threading.Thread(target=worker.run_task, args=(task,), daemon=True)
+    thread.start()
+    # Wait for the partial result sent after the progress
+    end_time = time.time() + 30
+    while task.task_result is None and time.time() < end_time:
+        time.sleep(0.01)
+    return thread
+
+
+def test_shared_arrays_and_preview_round_trip(worker):
+    task = make_task('run')
+    results = worker.run_task(task)
+
+    image = task.params.uov_input_image
+    assert [r.im for r in results] == ['first.png'] and not task.finish_with_error
+    assert task.timings['sum'] == int(image.sum()) and task.timings['mask_sum'] == 64 * 64
+    assert np.array_equal(task.step_preview_image, np.full((8, 8, 3), image.sum() % 256, dtype=np.uint8))
+    assert worker.preview_slot.buf[0] == preview_slot_free
+    assert [e.step for e in task.events.get_events()] == [1, None]
+    # Input segments are released after the task
+    assert len(task.timings['segments']) == 3
+    for name in task.timings['segments']:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_cancel_message(worker):
+    task = make_task('wait')
+    thread = run_in_thread(worker, task)
+    task.cancel_requested = True
+    worker.cancel_task(task)
+    thread.join(30)
+
+    assert task.finish_with_error and task.error_message == 'Job cancelled'
+    assert [r.finish_reason for r in task.task_result] == [GenerationFinishReason.success, GenerationFinishReason.user_cancel]
+
+
+def test_preempt_message(worker):
+    task = make_task('wait')
+    thread = run_in_thread(worker, task)
+    task.preempt_requested = True
+    worker.preempt_task(task)
+    thread.join(30)
+
+    assert task.checkpoint['next_index'] == 1 and not task.finish_with_error
+    assert [r.im for r in task.task_result] == ['first.png']
+
+    # The checkpoint is sent with the next run
+    task.set_result(None, False)
+    task.params.prompt = 'run'
+    worker.run_task(task)
+    assert task.timings['resumed'] and task.checkpoint is None
+
+
+def test_restart_after_crash(worker):
+    with pytest.raises(RuntimeError):
+        worker.run_task(make_task('crash'))
+    assert worker.process.is_alive()
+    assert worker.run_task(make_task('run'))[0].im == 'first.png'
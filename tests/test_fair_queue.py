@@ -0,0 +1,82 @@
+from typing import Dict, List
+
+import numpy as np
+import pytest
+
+from fooocusapi.task_queue import TaskPriority, TaskQueue, parse_client_weights
+from tests.utils import StubWorker, make_job, make_params, run_next_task
+
+
+def simulate(interactive_client: str, interactive_priority: TaskPriority = TaskPriority.normal) -> Dict[str, List[float]]:
+    """
+    One stub worker serving a dozen large Quality batches submitted at once by a bulk client, while an interactive
+    client submits a single image job every minute. Each task takes its estimated cost on a virtual clock.
+    :returns: Latency seconds from submit to finish of each job, by client
+    """
+    task_queue = TaskQueue(queue_size=1000, hisotry_size=1000)
+    worker = StubWorker()
+    task_queue.register_worker(worker)
+
+    submit_seconds = {}
+    arrivals = [(0.0, 'bulk', 'bulk', make_job(make_params(image_number=32, performance_selection='Quality')))] * 12
+    arrivals += [(60.0 * i, 'interactive', interactive_client, make_job(priority=interactive_priority)) for i in range(20)]
+    arrivals.sort(key=lambda a: a[0])
+
+    clock = 0.0
+    latencies = {'bulk': [], 'interactive': []}
+    while len(arrivals) > 0 or task_queue.get_job_count() > 0:
+        while len(arrivals) > 0 and arrivals[0][0] <= clock:
+            arrival_seconds, kind, client_id, job = arrivals.pop(0)
+            task = task_queue.add_task(client_id=client_id, **job)
+            submit_seconds[task.job_id] = (arrival_seconds, kind)
+        task = run_next_task(task_queue, worker)
+        if task is None:
+            clock = arrivals[0][0]
+            continue
+        clock += task.estimated_cost
+        arrival_seconds, kind = submit_seconds[task.job_id]
+        latencies[kind].append(clock - arrival_seconds)
+    return latencies
+
+
+def test_interactive_tail_latency_under_bulk_load():
+    # All jobs from one client in the same class are served in submit order
+    fifo = simulate('bulk')
+    fair = simulate('interactive')
+    high = simulate('interactive', TaskPriority.high)
+
+    bulk_job_seconds = TaskQueue(1, 1).throughput.estimate_job_cost(make_params(image_number=32, performance_selection='Quality'))
+    fifo_p99 = np.percentile(fifo['interactive'], 99)
+    fair_p99 = np.percentile(fair['interactive'], 99)
+    high_p99 = np.percentile(high['interactive'], 99)
+    print(f"Interactive p99 seconds, FIFO: {fifo_p99:.0f}, fair share: {fair_p99:.0f}, high priority: {high_p99:.0f}")
+
+    # Without preemption, an interactive job waits at most for the running bulk job
+    assert fair_p99 < bulk_job_seconds * 1.2
+    assert high_p99 < bulk_job_seconds * 1.2
+    assert fifo_p99 > fair_p99 * 5
+    # The bulk client still gets all its work done
+    assert len(fair['bulk']) == 12 and len(high['bulk']) == 12
+
+
+def test_client_weights_share():
+    task_queue = TaskQueue(queue_size=1000, hisotry_size=1000)
+    task_queue.client_weights = parse_client_weights('heavy=3, light=1')
+    worker = StubWorker()
+    task_queue.register_worker(worker)
+    for client_id in ('heavy', 'light'):
+        for _ in range(8):
+            task_queue.add_task(client_id=client_id, **make_job())
+
+    for _ in range(8):
+        run_next_task(task_queue, worker)
+    assert [t.client_id for t in worker.run_tasks].count('heavy') == 6
+
+
+def test_parse_client_weights():
+    assert parse_client_weights(None) == {}
+    assert parse_client_weights('a=2,b=0.5,') == {'a': 2.0, 'b': 0.5}
+    with pytest.raises(ValueError):
+        parse_client_weights('a=0')
+    with pytest.raises(ValueError):
+        parse_client_weights('=1')
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import time
+
+from fooocusapi.job_store import SqliteJobStore
+from fooocusapi.task_queue import TaskQueue
+from tests.utils import make_job
+
+
+def test_recover_deadline_and_coalesce_key(tmp_path):
+    path = os.path.join(tmp_path, 'jobs.db')
+    deadline_millis = int(time.time() * 1000) + 60000
+    job_store = SqliteJobStore(path)
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    task_queue.set_job_store(job_store)
+    task = task_queue.add_task(coalesce_key='same', deadline_millis=deadline_millis, **make_job())
+    job_store.close()
+
+    recovered_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    recovered_store = SqliteJobStore(path)
+    recovered_queue.set_job_store(recovered_store)
+    recovered = recovered_queue.get_task(task.job_id)
+    assert recovered.deadline_millis == deadline_millis
+    assert recovered.coalesce_key == 'same'
+    assert recovered_queue.add_task(coalesce_key='same', **make_job()) is recovered
+    recovered_store.close()
+
+
+def test_migrate_old_schema(tmp_path):
+    path = os.path.join(tmp_path, 'jobs.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE jobs (
+            job_id TEXT PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            priority TEXT NOT NULL,
+            client_id TEXT NOT NULL,
+            in_queue_millis INTEGER NOT NULL,
+            start_millis INTEGER NOT NULL,
+            finish_millis INTEGER NOT NULL,
+            finish_progress INTEGER NOT NULL,
+            task_status TEXT,
+            error_message TEXT,
+            req_param TEXT NOT NULL,
+            task_result TEXT,
+            params BLOB
+        )''')
+    conn.execute("INSERT INTO jobs VALUES ('old', 'Text to Image', 'SUCCESS', 'Normal', 'default', 0, 1, 2, 100, "
+                 "'Finished', NULL, '{}', '[]', NULL)")
+    conn.commit()
+    conn.close()
+
+    job_store = SqliteJobStore(path)
+    records = job_store.load_finished_tasks(10)
+    assert [r['job_id'] for r in records] == ['old']
+    assert records[0]['deadline_millis'] is None and records[0]['coalesce_key'] is None
+
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    task_queue.set_job_store(job_store)
+    task = task_queue.add_task(coalesce_key='key', **make_job())
+    job_store.close()
+    assert SqliteJobStore(path).load_unfinished_tasks()[0]['coalesce_key'] == task.coalesce_key
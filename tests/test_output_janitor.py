@@ -0,0 +1,31 @@
+import os
+
+import fooocusapi.file_utils as file_utils
+from fooocusapi.output_janitor import OutputJanitor
+
+
+def write_output(root_dir: str, filename: str) -> str:
+    os.makedirs(os.path.join(root_dir, os.path.dirname(filename)), exist_ok=True)
+    with open(os.path.join(root_dir, filename), 'wb') as f:
+        f.write(b'png')
+    file_utils.base64_cache[filename] = 'cached'
+    file_utils.base64_cache_bytes += len('cached')
+    return filename
+
+
+def test_deleted_files_leave_base64_cache(tmp_path):
+    root_dir = str(tmp_path)
+    janitor = OutputJanitor(root_dir=root_dir)
+    cached_bytes = file_utils.base64_cache_bytes
+    deleted = write_output(root_dir, os.path.join('2024-01-02', 'a.png'))
+    kept = write_output(root_dir, os.path.join('2024-01-02', 'b.png'))
+    in_dir = [write_output(root_dir, os.path.join('2024-01-01', f"{i}.png")) for i in range(3)]
+
+    janitor.remove_files([deleted])
+    janitor.remove_dir('2024-01-01', 0)
+
+    assert not os.path.exists(os.path.join(root_dir, deleted))
+    assert not os.path.exists(os.path.join(root_dir, '2024-01-01'))
+    assert all(f not in file_utils.base64_cache for f in [deleted] + in_dir)
+    assert kept in file_utils.base64_cache
+    assert file_utils.base64_cache_bytes == cached_bytes + len('cached')
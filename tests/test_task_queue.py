@@ -0,0 +1,262 @@
+import random
+import threading
+import time
+
+from fooocusapi.engine import complete_task, start_engine_workers
+from fooocusapi.parameters import GenerationFinishReason
+from fooocusapi.task_queue import TaskPriority, TaskQueue
+from tests.utils import StubWorker, make_job, make_params, run_next_task, start_stub_workers
+
+
+def hammer(task_queue: TaskQueue, threads: int, jobs_per_thread: int, workers: int = 2,
+           poll_interval: float = 0.001) -> dict:
+    """
+    Submit jobs from many threads which poll them until finished, while stub workers run them
+    """
+    stop = threading.Event()
+    worker_threads = start_stub_workers(task_queue, workers, stop)
+    submitted = []
+    errors = []
+    polls = [0]
+    lock = threading.Lock()
+
+    def client(client_index: int):
+        try:
+            tasks = []
+            for _ in range(jobs_per_thread // 2):
+                tasks += task_queue.add_tasks([make_job() for _ in range(random.randint(1, 3))], f"client-{client_index}")
+            count = 0
+            while not all(t.is_finished for t in tasks):
+                for task in tasks:
+                    assert task_queue.get_task(task.job_id, True) in (task, None)
+                    count += 1
+                task_queue.get_job_count()
+                time.sleep(poll_interval)
+            with lock:
+                submitted.extend(tasks)
+                polls[0] += count
+        except Exception as e:
+            errors.append(e)
+
+    start_time = time.perf_counter()
+    client_threads = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for thread in client_threads:
+        thread.start()
+    for thread in client_threads:
+        thread.join()
+    stop.set()
+    for thread in worker_threads:
+        thread.join()
+    return dict(seconds=time.perf_counter() - start_time, submitted=submitted, errors=errors, polls=polls[0])
+
+
+def test_concurrent_add_query_finish():
+    task_queue = TaskQueue(queue_size=100000, hisotry_size=50)
+    report = hammer(task_queue, threads=16, jobs_per_thread=40)
+
+    assert report['errors'] == []
+    submitted = report['submitted']
+    assert len(set(t.job_id for t in submitted)) == len(submitted)
+    assert all(t.future.done() and not t.finish_with_error for t in submitted)
+    assert task_queue.get_job_count() == 0
+    assert len(task_queue.queue) == 0
+    assert len(task_queue.history) == 50
+    assert set(task_queue.history_index) == set(t.job_id for t in task_queue.history)
+    assert sum(w.completed_tasks for w in task_queue.workers) == len(submitted)
+
+
+def test_coalesce_skips_cancelled_task():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    task = task_queue.add_task(coalesce_key='same', **make_job())
+    task_queue.cancel_task(task.job_id)
+
+    new_task = task_queue.add_task(coalesce_key='same', **make_job())
+    assert new_task is not task
+    assert not new_task.cancel_requested
+    assert task.task_result[-1].finish_reason == GenerationFinishReason.user_cancel
+    assert task_queue.add_task(coalesce_key='same', **make_job()) is new_task
+
+
+def test_coalesce_raises_priority():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    worker = StubWorker()
+    task_queue.register_worker(worker)
+    low_task = task_queue.add_task(priority=TaskPriority.low, coalesce_key='same', **make_job())
+    normal_task = task_queue.add_task(**make_job(make_params(prompt='other')))
+
+    assert task_queue.add_task(priority=TaskPriority.high, coalesce_key='same', **make_job()) is low_task
+    assert low_task.priority == TaskPriority.high
+    assert run_next_task(task_queue, worker) is low_task
+    assert run_next_task(task_queue, worker) is normal_task
+
+
+def test_concurrent_expire_and_cancel():
+    task_queue = TaskQueue(queue_size=1000, hisotry_size=1000)
+    tasks = [task_queue.add_task(deadline_millis=int(time.time() * 1000) + 50, **make_job()) for _ in range(300)]
+    time.sleep(0.1)
+    errors = []
+
+    def run(action):
+        try:
+            action()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(task_queue.expire_tasks,)) for _ in range(4)]
+    threads += [threading.Thread(target=run, args=(lambda: [task_queue.cancel_task(t.job_id) for t in tasks],))
+                for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert task_queue.get_job_count() == 0
+    for task in tasks:
+        assert task.future.done() and len(task.task_result) == 1
+
+
+def test_expire_while_workers_busy():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    # A worker stuck in a long task never looks for the next one
+    worker = StubWorker()
+    task_queue.register_worker(worker)
+    running_task = task_queue.add_task(**make_job())
+    assert task_queue.wait_next_task(worker, 0) is running_task
+
+    task = task_queue.add_task(deadline_millis=int(time.time() * 1000) + 100, **make_job(make_params(prompt='other')))
+    results = task.future.result(timeout=5)
+    assert results[-1].finish_reason == GenerationFinishReason.deadline_exceeded
+    assert task.is_finished and task_queue.get_job_count() == 1
+
+
+def test_expired_split_task_counted_once():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    task_queue.batch_split_size = 1
+    task = task_queue.add_task(deadline_millis=int(time.time() * 1000) + 50, **make_job(make_params(image_number=4)))
+    assert len(task.sub_tasks) == 4
+    time.sleep(0.1)
+    task_queue.expire_tasks()
+
+    assert task.is_finished and task.task_result[-1].finish_reason == GenerationFinishReason.deadline_exceeded
+    assert task_queue.deadline_expired_jobs == 1
+    assert abs(task_queue.deadline_saved_seconds - sum(t.estimated_cost for t in task.sub_tasks)) < 1e-6
+
+
+def test_estimated_times_of_expiring_split_task():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    task_queue.batch_split_size = 2
+    task = task_queue.add_task(deadline_millis=int(time.time() * 1000) + 60000, **make_job(make_params(image_number=4)))
+    assert len(task.sub_tasks) == 2
+    for sub_task in task.sub_tasks:
+        sub_task.deadline_millis = int(time.time() * 1000) - 1
+
+    assert task_queue.update_estimated_times() == {}
+    assert task_queue.get_retry_after() == 1
+
+
+def test_cancel_while_suspending():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    worker = StubWorker()
+    task_queue.register_worker(worker)
+    task = task_queue.add_task(**make_job(make_params(image_number=4)))
+    assert task_queue.wait_next_task(worker, 0) is task
+
+    # Preempted after the first image, the cancel arrives before the task is queued again
+    results = worker.run_task(task)[:1]
+    task.set_checkpoint(dict(seed=1, next_index=1, results=results))
+    task_queue.cancel_task(task.job_id)
+    complete_task(task_queue, task, results)
+
+    assert task.is_finished and task.future.done()
+    assert [r.finish_reason for r in task.task_result] == [GenerationFinishReason.success, GenerationFinishReason.user_cancel]
+    assert task_queue.get_job_count() == 0 and worker.is_idle()
+
+
+def test_batch_exceeds_capacity():
+    task_queue = TaskQueue(queue_size=3, hisotry_size=10)
+    jobs = [make_job(make_params(prompt=str(i))) for i in range(4)]
+    assert task_queue.exceeds_capacity(jobs) and task_queue.add_tasks(jobs) is None
+    assert len(task_queue.add_tasks(jobs[:3])) == 3
+    # Full for now, accepted again once the queue drains
+    assert task_queue.add_tasks(jobs[3:]) is None and not task_queue.exceeds_capacity(jobs[3:])
+
+    task_queue = TaskQueue(queue_size=3, hisotry_size=10, queue_max_wait=60)
+    quality_jobs = [make_job(make_params(prompt=str(i), image_number=32, performance_selection='Quality')) for i in range(2)]
+    assert task_queue.exceeds_capacity(quality_jobs) and task_queue.add_tasks(quality_jobs) is None
+    # A single job always fits in an empty queue
+    assert not task_queue.exceeds_capacity(quality_jobs[:1]) and task_queue.add_tasks(quality_jobs[:1]) is not None
+
+
+def test_batch_admitted_only_if_last_job_fits():
+    job_cost = TaskQueue(1, 1).throughput.estimate_job_cost(make_params(performance_selection='Quality'))
+    task_queue = TaskQueue(queue_size=3, hisotry_size=10, queue_max_wait=job_cost * 2.5)
+    quality_jobs = [make_job(make_params(prompt=str(i), performance_selection='Quality')) for i in range(6)]
+    assert task_queue.add_task(**quality_jobs[0]) is not None
+
+    # Three jobs never fit behind the queued one, but each one would wait within the limit on an empty queue
+    assert not task_queue.exceeds_capacity(quality_jobs[1:4])
+    assert task_queue.add_tasks(quality_jobs[1:4]) is None
+    # The same jobs sent one at a time are accepted only while they fit
+    assert [task_queue.add_task(**job) is not None for job in quality_jobs[1:4]] == [True, True, False]
+    assert task_queue.get_projected_wait() <= job_cost * 3.5
+
+
+def test_suspend_twice():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    worker = StubWorker()
+    task_queue.register_worker(worker)
+    task = task_queue.add_task(**make_job(make_params(image_number=4)))
+
+    results = worker.run_task(task)
+    for next_index in (1, 2):
+        assert task_queue.wait_next_task(worker, 0) is task
+        task.set_checkpoint(dict(seed=1, next_index=next_index, results=results[:next_index]))
+        complete_task(task_queue, task, results[:next_index])
+
+    assert not task.is_finished and task.start_millis == 0
+    assert task.estimated_cost == task_queue.throughput.estimate_job_cost(task.params) * 0.5
+    assert task_queue.preempted_jobs == 2
+
+
+def test_engine_loop_survives_dispatch_error():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    wait_next_task = task_queue.wait_next_task
+    calls = [0]
+
+    def failing_wait_next_task(worker, timeout=None):
+        calls[0] += 1
+        if calls[0] == 1:
+            raise RuntimeError('Dispatch error')
+        return wait_next_task(worker, timeout)
+
+    task_queue.wait_next_task = failing_wait_next_task
+    start_engine_workers(task_queue, [StubWorker()])
+    task = task_queue.add_task(**make_job())
+    assert len(task.future.result(timeout=10)) == 1
+    assert calls[0] >= 2
+
+
+def test_estimated_times_cached_until_queue_changes():
+    task_queue = TaskQueue(queue_size=10, hisotry_size=10)
+    first = task_queue.add_task(**make_job())
+    estimated_times = task_queue.update_estimated_times()
+    assert task_queue.update_estimated_times() is estimated_times
+
+    second = task_queue.add_task(**make_job(make_params(prompt='other')))
+    estimated_times = task_queue.update_estimated_times()
+    assert set(estimated_times) == {first.job_id, second.job_id}
+    assert estimated_times[second.job_id][0] == estimated_times[first.job_id][1]
+
+    task_queue.estimated_times_max_age_millis = 0
+    assert task_queue.update_estimated_times() is not estimated_times
+
+
+if __name__ == '__main__':
+    # Stress benchmark: python -m tests.test_task_queue
+    for thread_count in (1, 8, 32, 64):
+        result = hammer(TaskQueue(queue_size=1000000, hisotry_size=1000), threads=thread_count, jobs_per_thread=50)
+        jobs = len(result['submitted'])
+        print(f"{thread_count} threads: {jobs} jobs, {result['polls']} polls in {result['seconds']:.2f}s, "
+              f"{jobs / result['seconds']:.0f} jobs/s, {result['polls'] / result['seconds']:.0f} polls/s, "
+              f"errors: {len(result['errors'])}")
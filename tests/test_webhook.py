@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+import pytest
+
+from fooocusapi.webhook import WebhookDispatcher
+
+
+class WebhookReceiver(object):
+    """
+    Local HTTP stand-in for a webhook receiver, answers with the scripted statuses and then 200
+    """
+
+    def __init__(self, statuses: List[Tuple[int, dict]] | None = None):
+        self.statuses = list(statuses or [])
+        self.bodies: List[dict] = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                receiver.bodies.append(body)
+                status, headers = receiver.statuses.pop(0) if len(receiver.statuses) > 0 else (200, {})
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/webhook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def receiver_factory():
+    receivers = []
+
+    def create(statuses: List[Tuple[int, dict]] | None = None) -> WebhookReceiver:
+        receivers.append(WebhookReceiver(statuses))
+        return receivers[-1]
+
+    yield create
+    for receiver in receivers:
+        receiver.close()
+
+
+def wait_done(dispatcher: WebhookDispatcher, count: int):
+    end_time = time.time() + 10
+    while dispatcher.delivered + dispatcher.failed < count and time.time() < end_time:
+        time.sleep(0.01)
+
+
+def test_retry_with_backoff(receiver_factory):
+    receiver = receiver_factory([(503, {}), (429, {'Retry-After': '0'}), (500, {})])
+    dispatcher = WebhookDispatcher(receiver.url, backoff_seconds=0.01)
+    start_time = time.time()
+    dispatcher.send({'job_id': 'a'})
+    wait_done(dispatcher, 1)
+
+    assert dispatcher.delivered == 1 and dispatcher.failed == 0
+    assert receiver.bodies == [{'job_id': 'a'}] * 4
+    assert time.time() - start_time < 5
+
+
+def test_give_up(receiver_factory):
+    rejected = receiver_factory([(400, {})])
+    dispatcher = WebhookDispatcher(rejected.url, backoff_seconds=0.01)
+    dispatcher.send({'job_id': 'a'})
+    wait_done(dispatcher, 1)
+    # Client errors are not retried
+    assert dispatcher.failed == 1 and len(rejected.bodies) == 1
+
+    failing = receiver_factory([(500, {})] * 10)
+    dispatcher = WebhookDispatcher(failing.url, max_retries=2, backoff_seconds=0.01)
+    dispatcher.send({'job_id': 'b'})
+    wait_done(dispatcher, 1)
+    assert dispatcher.failed == 1 and len(failing.bodies) == 3
+
+
+def test_spool_and_batch(receiver_factory, tmp_path):
+    spool_dir = str(tmp_path)
+    # Notifications left by a previous run are delivered together
+    for index in range(3):
+        with open(os.path.join(spool_dir, f"{index:020d}-test.json"), 'w', encoding='utf-8') as f:
+            json.dump({'job_id': str(index)}, f)
+    receiver = receiver_factory()
+    dispatcher = WebhookDispatcher(receiver.url, spool_dir=spool_dir, batch_size=3)
+    wait_done(dispatcher, 3)
+
+    assert receiver.bodies == [{'jobs': [{'job_id': '0'}, {'job_id': '1'}, {'job_id': '2'}]}]
+    assert os.listdir(spool_dir) == []
+
+    # New notifications are spooled until delivered
+    dispatcher.send({'job_id': '3'})
+    wait_done(dispatcher, 4)
+    assert receiver.bodies[-1] == {'jobs': [{'job_id': '3'}]}
+    assert os.listdir(spool_dir) == []
+
+
+def test_spool_kept_until_delivered(receiver_factory, tmp_path):
+    spool_dir = str(tmp_path)
+    receiver = receiver_factory([(503, {})] * 3)
+    dispatcher = WebhookDispatcher(receiver.url, spool_dir=spool_dir, backoff_seconds=0.5, max_retries=3)
+    dispatcher.send({'job_id': 'a'})
+    end_time = time.time() + 5
+    while len(receiver.bodies) == 0 and time.time() < end_time:
+        time.sleep(0.01)
+
+    spooled = [f for f in os.listdir(spool_dir) if f.endswith('.json')]
+    assert len(spooled) == 1
+    with open(os.path.join(spool_dir, spooled[0]), 'r', encoding='utf-8') as f:
+        assert json.load(f) == {'job_id': 'a'}
+    wait_done(dispatcher, 1)
+    assert dispatcher.delivered == 1 and os.listdir(spool_dir) == []
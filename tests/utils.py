@@ -0,0 +1,77 @@
+import threading
+from typing import List
+
+from fooocusapi.engine import EngineWorker, complete_task
+from fooocusapi.parameters import (GenerationFinishReason, ImageGenerationParams, ImageGenerationResult,
+                                   default_aspect_ratio, default_base_model_name, default_refiner_model_name)
+from fooocusapi.task_queue import QueueTask, TaskQueue, TaskType
+
+
+def make_params(image_number: int = 1, performance_selection: str = 'Speed',
+                base_model_name: str = default_base_model_name, image_seed: int = -1,
+                prompt: str = '') -> ImageGenerationParams:
+    return ImageGenerationParams(prompt=prompt, negative_prompt='', style_selections=[],
+                                 performance_selection=performance_selection, aspect_ratios_selection=default_aspect_ratio,
+                                 image_number=image_number, image_seed=image_seed, sharpness=2.0, guidance_scale=4.0,
+                                 base_model_name=base_model_name, refiner_model_name=default_refiner_model_name,
+                                 refiner_switch=0.5, loras=[], uov_input_image=None, uov_method='Disabled',
+                                 upscale_value=None, outpaint_selections=[], outpaint_distance_left=0,
+                                 outpaint_distance_right=0, outpaint_distance_top=0, outpaint_distance_bottom=0,
+                                 inpaint_input_image=None, inpaint_additional_prompt=None, image_prompts=[],
+                                 advanced_params=None)
+
+
+def make_job(params: ImageGenerationParams | None = None, **kwargs) -> dict:
+    """
+    Arguments of `TaskQueue.add_task` for a text to image job
+    """
+    job = dict(type=TaskType.text_2_img, req_param={}, params=make_params() if params is None else params)
+    job.update(kwargs)
+    return job
+
+
+class StubWorker(EngineWorker):
+    """
+    Engine worker standing in for `process_generate`, each task returns one result per image at once
+    """
+
+    def __init__(self, worker_id: int = 0):
+        super().__init__(worker_id)
+        self.run_tasks: List[QueueTask] = []
+
+    def run_task(self, task: QueueTask) -> List[ImageGenerationResult]:
+        self.run_tasks.append(task)
+        image_number = 1 if task.params is None else task.params.image_number
+        results = [ImageGenerationResult(im=None, seed=str(i), finish_reason=GenerationFinishReason.success)
+                   for i in range(image_number)]
+        task.set_result(results, False)
+        return results
+
+
+def run_next_task(task_queue: TaskQueue, worker: EngineWorker, timeout: float = 0) -> QueueTask | None:
+    """
+    One iteration of `engine_loop` which gives up when no task is dispatched within the timeout
+    """
+    task = task_queue.wait_next_task(worker, timeout)
+    if task is None:
+        return None
+    complete_task(task_queue, task, worker.run_task(task))
+    return task
+
+
+def start_stub_workers(task_queue: TaskQueue, count: int, stop: threading.Event) -> List[threading.Thread]:
+    """
+    Run stub workers until `stop` is set and no task is left
+    """
+    def loop(worker: StubWorker):
+        while run_next_task(task_queue, worker, 0.05) is not None or not stop.is_set():
+            pass
+
+    threads = []
+    for worker_id in range(count):
+        worker = StubWorker(worker_id)
+        task_queue.register_worker(worker)
+        thread = threading.Thread(target=loop, args=(worker,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads